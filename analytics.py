@@ -0,0 +1,468 @@
+import argparse
+import itertools
+import sys
+
+import numpy as np
+
+import demand
+import fasttree
+import montecarlo
+import termcache
+import weights
+from fasttree import DONE, EMPTY, NODES, NUM_NODES
+from termcache import CLASS_YEARS
+from weights import MAX_COURSES
+
+# Percentiles reported in the summary tables.
+PERCENTILES = (10, 25, 50, 75, 90)
+
+# Failure moves as an array, with DONE leading back to DONE.
+_ON_FAILURE = np.array(fasttree.ON_FAILURE + (DONE,), dtype=np.intp)
+
+
+def assignment_arrays(store, assignments, as_indices=False):
+    """Flattens an assignment dictionary into parallel arrays.
+
+    A student gets at most one course per pass, and a student who gets
+    nothing in a pass has exhausted their tree, so the k-th course in a
+    student's list is always the one they got in pass k.
+
+    Parameters:
+        store - the fasttree.PreferenceStore the run was made over.
+        assignments - a dictionary mapping student IDs to lists of CRNs
+                      (or course indices, if as_indices is True).
+        as_indices - True if the lists hold course indices.
+
+    Returns:
+        Three intp arrays (rows, passes, courses), one entry per assignment.
+    """
+    lists = list(assignments.values())
+    counts = np.fromiter(map(len, lists), dtype=np.intp, count=len(lists))
+    total = int(counts.sum())
+    flat = np.fromiter(itertools.chain.from_iterable(lists), dtype=np.int64,
+                       count=total)
+    student_rows = np.searchsorted(store.ids, np.fromiter(
+        assignments, dtype=np.int64, count=len(lists)))
+    rows = np.repeat(student_rows, counts)
+    starts = np.cumsum(counts) - counts
+    passes = np.arange(total, dtype=np.intp) - np.repeat(starts, counts)
+    if as_indices:
+        courses = flat.astype(np.intp)
+    else:
+        courses = np.searchsorted(store.crns, flat)
+    return rows, passes, courses
+
+
+def satisfied_nodes(store, rows, passes, courses):
+    """Returns the WebTree node at which each assignment was made.
+
+    Replays every student's walk, all students at once: in each pass the
+    cursor follows failure moves until it reaches a node holding the course
+    the student got. A course on the failure chain before that node would
+    have had the same seats at that moment, so the first match is the node
+    the scheduler took.
+
+    Parameters:
+        store - the fasttree.PreferenceStore the run was made over.
+        rows, passes, courses - as returned by assignment_arrays.
+
+    Returns:
+        An intp array of node numbers, parallel to rows.
+    """
+    prefs = np.hstack([store.prefs,
+                       np.full((len(store), 1), EMPTY, dtype=np.int32)])
+    on_success = np.array(fasttree.ON_SUCCESS + (DONE,), dtype=np.intp)
+    got = np.full((len(store), MAX_COURSES), EMPTY - 1, dtype=np.intp)
+    got[rows, passes] = courses
+    slot = np.full((len(store), MAX_COURSES), -1, dtype=np.intp)
+    slot[rows, passes] = np.arange(len(rows))
+
+    nodes = np.empty(len(rows), dtype=np.intp)
+    cursors = np.zeros(len(store), dtype=np.intp)
+    for k in range(MAX_COURSES):
+        active = np.flatnonzero(slot[:, k] >= 0)
+        node = cursors[active]
+        wanted = got[active, k]
+        miss = np.flatnonzero(prefs[active, node] != wanted)
+        while len(miss):
+            node[miss] = _ON_FAILURE[node[miss]]
+            if (node[miss] == DONE).any():
+                raise ValueError("assignments do not match the preference store")
+            miss = miss[prefs[active[miss], node[miss]] != wanted[miss]]
+        nodes[slot[active, k]] = node
+        cursors[active] = on_success[node]
+    return nodes
+
+
+def ordering_positions(store, random_ordering):
+    """Returns each student's position in each pass of an ordering.
+
+    Returns:
+        A MAX_COURSES x students intp matrix; entry (k, row) counts the
+        students scheduled before that student in pass k.
+    """
+    positions = np.zeros((MAX_COURSES, len(store)), dtype=np.intp)
+    for k in range(MAX_COURSES):
+        sequence = list(itertools.chain.from_iterable(
+            random_ordering[class_year][k] for class_year in CLASS_YEARS))
+        ids = np.array(sequence, dtype=np.int64)
+        positions[k, np.searchsorted(store.ids, ids)] = np.arange(len(ids))
+    return positions
+
+
+def histogram_percentiles(counts, percentiles=PERCENTILES):
+    """Returns percentiles of a distribution given as a histogram.
+
+    Parameters:
+        counts - counts[v] is the number of observations of value v.
+        percentiles - the percentiles wanted (0-100).
+
+    Returns:
+        A list of values, one per percentile, or Nones if counts is empty.
+    """
+    cumulative = np.cumsum(counts)
+    if not len(cumulative) or cumulative[-1] == 0:
+        return [None] * len(percentiles)
+    targets = np.array(percentiles, dtype=np.float64) / 100.0 * cumulative[-1]
+    targets = np.maximum(targets, 1)
+    return np.searchsorted(cumulative, targets).tolist()
+
+
+def histogram_mean(counts):
+    """Returns the mean of a distribution given as a histogram."""
+    total = counts.sum()
+    if total == 0:
+        return float('nan')
+    return float(np.dot(np.arange(len(counts)), counts)) / total
+
+
+class OutcomeStats:
+    """Running totals of the outcomes of many lotteries over one term.
+
+    Every total has a fixed size set by the term, not by the number of runs,
+    so any number of runs can be streamed through add(). Totals from
+    different processes are combined with merge().
+
+    Attributes:
+        runs - the number of runs added.
+        received - int64 array of courses received per student, summed
+                   over runs.
+        utility - int64 array of the weight of the nodes each student was
+                  satisfied at, summed over runs.
+        levels - students x demand.LEVELS counts of the courses each student
+                 got at each tree level, summed over runs.
+        received_hist - CLASS_YEARS x (MAX_COURSES + 1) counts of students
+                        receiving each number of courses.
+        node_hist - CLASS_YEARS x NUM_NODES counts of assignments made at
+                    each node.
+        utility_hist - CLASS_YEARS x (max utility + 1) counts of students
+                       with each total utility.
+        taken - int64 array of seats taken per course, summed over runs.
+        taken_by_class - courses x CLASS_YEARS seats taken, summed over runs.
+        filled - int64 array of runs in which each course filled.
+        fill_pass - courses x MAX_COURSES counts of the pass in which each
+                    course filled.
+        fill_steps - int64 array summing, over runs in which each course
+                     filled, the number of scheduling steps taken when its
+                     last seat went. Integer totals make merged results
+                     independent of the order chunks arrive in.
+    """
+    def __init__(self, store):
+        """Constructs empty totals for runs over store."""
+        self.store = store
+        self._codes = store.class_codes.astype(np.intp)
+        self._node_weights = weights.node_weights(store)
+        num_students = len(store)
+        num_courses = len(store.crns)
+        num_classes = len(CLASS_YEARS)
+        max_utility = MAX_COURSES * int(self._node_weights.max(initial=0))
+
+        self.runs = 0
+        self.received = np.zeros(num_students, dtype=np.int64)
+        self.utility = np.zeros(num_students, dtype=np.int64)
+        self.levels = np.zeros((num_students, len(demand.LEVELS)),
+                               dtype=np.int64)
+        self.received_hist = np.zeros((num_classes, MAX_COURSES + 1),
+                                      dtype=np.int64)
+        self.node_hist = np.zeros((num_classes, NUM_NODES), dtype=np.int64)
+        self.utility_hist = np.zeros((num_classes, max_utility + 1),
+                                     dtype=np.int64)
+        self.taken = np.zeros(num_courses, dtype=np.int64)
+        self.taken_by_class = np.zeros((num_courses, num_classes),
+                                       dtype=np.int64)
+        self.filled = np.zeros(num_courses, dtype=np.int64)
+        self.fill_pass = np.zeros((num_courses, MAX_COURSES), dtype=np.int64)
+        self.fill_steps = np.zeros(num_courses, dtype=np.int64)
+
+    def __getstate__(self):
+        """Pickles the totals only; the receiver supplies the store."""
+        state = dict(self.__dict__)
+        for name in ('store', '_codes', '_node_weights'):
+            state.pop(name, None)
+        return state
+
+    def add(self, assignments, random_ordering, as_indices=False):
+        """Adds one run to the totals.
+
+        Parameters:
+            assignments - as returned by fasttree.run_webtree.
+            random_ordering - the ordering the run was made with.
+            as_indices - True if assignments hold course indices.
+
+        Returns:
+            None.
+        """
+        rows, passes, courses = assignment_arrays(self.store, assignments,
+                                                  as_indices)
+        self._add_arrays(rows, passes, courses, random_ordering)
+
+    def add_received(self, received, random_ordering):
+        """Adds one run, given in the layout of batchsim.run_batch_arrays.
+
+        Parameters:
+            received - a students x 4 array of the course index each student
+                       received in each pass, or EMPTY.
+            random_ordering - the ordering the run was made with.
+
+        Returns:
+            None.
+        """
+        rows, passes = np.nonzero(received != EMPTY)
+        self._add_arrays(rows, passes, received[rows, passes].astype(np.intp),
+                         random_ordering)
+
+    def _add_arrays(self, rows, passes, courses, random_ordering):
+        """Adds one run given as arrays, as from assignment_arrays."""
+        store = self.store
+        num_students = len(store)
+        num_courses = len(store.crns)
+        num_classes = len(CLASS_YEARS)
+        nodes = satisfied_nodes(store, rows, passes, courses)
+        codes = self._codes[rows]
+
+        # Students.
+        received = np.bincount(rows, minlength=num_students)
+        utility = np.bincount(rows, weights=self._node_weights[rows, nodes],
+                              minlength=num_students).astype(np.int64)
+        self.runs += 1
+        self.received += received
+        self.utility += utility
+        self.levels += np.bincount(
+            rows * len(demand.LEVELS) + demand.NODE_LEVELS[nodes],
+            minlength=self.levels.size).reshape(self.levels.shape)
+        self.received_hist += np.bincount(
+            self._codes * (MAX_COURSES + 1) + received,
+            minlength=self.received_hist.size).reshape(self.received_hist.shape)
+        self.node_hist += np.bincount(
+            codes * NUM_NODES + nodes,
+            minlength=self.node_hist.size).reshape(self.node_hist.shape)
+        width = self.utility_hist.shape[1]
+        self.utility_hist += np.bincount(
+            self._codes * width + utility,
+            minlength=self.utility_hist.size).reshape(self.utility_hist.shape)
+
+        # Courses.
+        taken = np.bincount(courses, minlength=num_courses)
+        self.taken += taken
+        self.taken_by_class += np.bincount(
+            courses * num_classes + codes,
+            minlength=self.taken_by_class.size).reshape(self.taken_by_class.shape)
+        steps = (passes * num_students +
+                 ordering_positions(store, random_ordering)[passes, rows])
+        last = np.full(num_courses, -1, dtype=np.intp)
+        np.maximum.at(last, courses, steps)
+        filled = np.flatnonzero((taken >= store.ceilings) & (store.ceilings > 0))
+        self.filled[filled] += 1
+        self.fill_pass[filled, last[filled] // num_students] += 1
+        self.fill_steps[filled] += last[filled] + 1
+
+    def merge(self, other):
+        """Adds the totals of another OutcomeStats over the same term."""
+        for name, value in other.__getstate__().items():
+            if name == 'runs':
+                self.runs += value
+            else:
+                getattr(self, name).__iadd__(value)
+
+    def class_summary(self):
+        """Yields one summary row per class year.
+
+        Each row is (class_year, students, mean courses, course percentiles,
+        mean utility, utility percentiles), over every student-run.
+        """
+        counts = np.bincount(self._codes, minlength=len(CLASS_YEARS))
+        for code, class_year in enumerate(CLASS_YEARS):
+            yield (class_year, int(counts[code]),
+                   histogram_mean(self.received_hist[code]),
+                   histogram_percentiles(self.received_hist[code]),
+                   histogram_mean(self.utility_hist[code]),
+                   histogram_percentiles(self.utility_hist[code]))
+
+    def student_rows(self):
+        """Yields one row of per-student metrics per student.
+
+        Each row is (id, class_year, mean courses, mean utility, mean
+        courses got at each of demand.LEVELS).
+        """
+        runs = float(max(self.runs, 1))
+        for id, code, received, utility, levels in zip(
+                self.store.ids.tolist(), self._codes.tolist(),
+                (self.received / runs).tolist(),
+                (self.utility / runs).tolist(),
+                (self.levels / runs).tolist()):
+            yield id, CLASS_YEARS[code], received, utility, levels
+
+    def course_rows(self):
+        """Yields one row of per-course metrics per course.
+
+        Each row is (crn, ceiling, mean seats taken, mean fill rate,
+        probability of filling, probabilities of filling in each pass,
+        mean fill point, mean seats taken per class year). The fill rate is
+        None for a course with no seats, and the fill point (the fraction of
+        all scheduling steps taken when the last seat went) is None for a
+        course that never filled.
+        """
+        runs = float(max(self.runs, 1))
+        ceilings = self.store.ceilings
+        taken = self.taken / runs
+        steps = float(MAX_COURSES * len(self.store))
+        for c, crn in enumerate(self.store.crns.tolist()):
+            ceiling = int(ceilings[c])
+            fill_rate = taken[c] / ceiling if ceiling else None
+            filled = int(self.filled[c])
+            fill_point = self.fill_steps[c] / (filled * steps) if filled else None
+            yield (crn, ceiling, taken[c], fill_rate, filled / runs,
+                   (self.fill_pass[c] / runs).tolist(), fill_point,
+                   (self.taken_by_class[c] / runs).tolist())
+
+
+def _run_draws(store, master_seed, start, stop):
+    """Runs draws [start, stop) and returns their OutcomeStats."""
+    stats = OutcomeStats(store)
+    for orderings, received in montecarlo.run_draws(store, master_seed,
+                                                    start, stop):
+        for ordering, run in zip(orderings, received):
+            stats.add_received(run, ordering)
+    return stats
+
+
+def collect(filename, draws, master_seed=0, processes=None, chunk_size=None):
+    """Runs many lotteries over one term and gathers their outcomes.
+
+    Draws are seeded and chunked as in montecarlo.run_lotteries, so the same
+    master seed analyses the same lotteries. Workers send back only their
+    totals.
+
+    Parameters:
+        See montecarlo.run_lotteries.
+
+    Returns:
+        An OutcomeStats object.
+    """
+    store = fasttree.PreferenceStore.from_term(termcache.load_term(filename))
+    stats = OutcomeStats(store)
+    for chunk in montecarlo.map_draws(filename, store, _run_draws, draws,
+                                      master_seed, processes, chunk_size):
+        stats.merge(chunk)
+    return stats
+
+
+def _format(value, spec):
+    """Formats a value, or '' for None."""
+    if value is None:
+        return ''
+    return spec % value
+
+
+def write_summary(stats, out):
+    """Writes the per-class summary and distribution tables as text."""
+    header = ' '.join('p%-3d' % p for p in PERCENTILES)
+    out.write('%d lotteries, %d students, %d courses\n\n'
+              % (stats.runs, len(stats.store), len(stats.store.crns)))
+
+    out.write('%-6s %8s | %7s %s | %7s %s\n'
+              % ('CLASS', 'STUDENTS', 'COURSES', header, 'UTILITY', header))
+    for (class_year, students, courses, course_ps,
+         utility, utility_ps) in stats.class_summary():
+        if not students:
+            continue
+        out.write('%-6s %8d | %7.3f %s | %7.2f %s\n' % (
+            class_year, students, courses,
+            ' '.join('%-4d' % p for p in course_ps), utility,
+            ' '.join('%-4d' % p for p in utility_ps)))
+
+    present = [code for code, class_year in enumerate(CLASS_YEARS)
+               if stats.received_hist[code].any()]
+    columns = ' '.join('%6s' % CLASS_YEARS[code] for code in present)
+
+    out.write('\nCourses received (share of students)\n%-6s %s\n'
+              % ('', columns))
+    for n in range(MAX_COURSES + 1):
+        out.write('%-6d %s\n' % (n, ' '.join(
+            '%6.3f' % (stats.received_hist[code, n] /
+                       float(stats.received_hist[code].sum()))
+            for code in present)))
+
+    out.write('\nSatisfied at node (share of assignments)\n%-6s %s\n'
+              % ('', columns))
+    for n, (tree, branch) in enumerate(NODES):
+        out.write('%-6s %s\n' % ('%d-%d' % (tree, branch), ' '.join(
+            '%6.3f' % (stats.node_hist[code, n] /
+                       float(max(stats.node_hist[code].sum(), 1)))
+            for code in present)))
+
+
+def write_courses(stats, out):
+    """Writes the per-course metrics as CSV."""
+    out.write('CRN,CEILING,MEAN_TAKEN,FILL_RATE,P_FILLED,%s,MEAN_FILL_POINT,%s\n'
+              % (','.join('P_FILL_PASS%d' % (k + 1) for k in range(MAX_COURSES)),
+                 ','.join('TAKEN_%s' % class_year
+                          for class_year in CLASS_YEARS)))
+    for (crn, ceiling, taken, fill_rate, p_filled, fill_passes, fill_point,
+         by_class) in stats.course_rows():
+        out.write('%d,%d,%.4f,%s,%.4f,%s,%s,%s\n' % (
+            crn, ceiling, taken, _format(fill_rate, '%.4f'), p_filled,
+            ','.join('%.4f' % p for p in fill_passes),
+            _format(fill_point, '%.4f'),
+            ','.join('%.4f' % t for t in by_class)))
+
+
+def write_students(stats, out):
+    """Writes the per-student metrics as CSV."""
+    out.write('ID,CLASS,MEAN_COURSES,MEAN_UTILITY,%s\n'
+              % ','.join('AT_%s' % name for name in demand.LEVEL_NAMES))
+    for id, class_year, received, utility, levels in stats.student_rows():
+        out.write('%d,%s,%.4f,%.4f,%s\n' % (
+            id, class_year, received, utility,
+            ','.join('%.4f' % n for n in levels)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Summarize student and course outcomes over many "
+                    "WebTree lotteries.")
+    parser.add_argument('filename', help="a .csv file of WebTree data")
+    parser.add_argument('draws', type=int, help="number of lotteries to run")
+    parser.add_argument('--seed', type=int, default=0, help="master seed")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument('--courses', metavar='FILE',
+                        help="also write per-course metrics as CSV")
+    parser.add_argument('--students', metavar='FILE',
+                        help="also write per-student metrics as CSV")
+    args = parser.parse_args()
+    if args.draws < 1:
+        parser.error("draws must be at least 1")
+
+    stats = collect(args.filename, args.draws, args.seed, args.processes)
+    write_summary(stats, sys.stdout)
+    if args.courses:
+        with open(args.courses, 'w') as out:
+            write_courses(stats, out)
+    if args.students:
+        with open(args.students, 'w') as out:
+            write_students(stats, out)
+
+
+if __name__ == "__main__":
+    main()
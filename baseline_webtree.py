@@ -1,11 +1,15 @@
 
+import argparse
 import csv
+import heapq
 import sys
 import random
+from fields import FIELDS
 from student import Student
-
-FIELDS = ['ID','CLASS','CRN','TREE','BRANCH','COURSE_CEILING',
-          'MAJOR','MAJOR2','SUBJ','NUMB','SEQ']
+import termcache
+import fasttree
+import instrument
+import results
 
 def read_file(filename):
     """Returns data read in from supplied WebTree data file.
@@ -144,13 +148,84 @@ def run_webtree(student_requests, students_by_class, courses, random_ordering):
     # Note: apparently, WebTree does a second pass at this point to "fill out"
     # student schedules further (especially those who received fewer than 4
     # courses). But again, details are unclear and no one can quite describe
-    # what *precisely* happens during this phase. So we skip that here.
+    # what *precisely* happens during this phase. So we skip that here; see
+    # fill_out for an optional reading of it.
                                         
     return assignments
 
 
+def fill_out(student_requests, courses, random_ordering, assignments):
+    """Gives students with fewer than four courses any requested courses that
+    still have space after run_webtree.
+
+    Students take turns in rounds: each under-filled student gets at most one
+    course per round, and within a round seniors go before juniors and so on,
+    then by position in the first pass's ordering. A student's candidate is
+    the first request, in level order over all four trees, that is still open
+    and not already on their schedule.
+
+    Only courses with seats left are indexed, and a course never reopens, so
+    each student's level-order position only moves forward. The work is thus
+    the under-filled students' requests plus a heap operation per seat filled,
+    rather than students times courses.
+
+    Parameters:
+        assignments - the dictionary returned by run_webtree; it is extended
+                      in place.
+        See descriptions from other function headers.
+
+    Returns:
+        The assignments dictionary.
+    """
+    open_seats = {}
+    for crn in courses:
+        if courses[crn] > 0:
+            open_seats[crn] = courses[crn]
+
+    queue = []
+    class_years = ['SENI', 'JUNI', 'SOPH', 'FRST', 'OTHER']
+    for rank, class_year in enumerate(class_years):
+        for position, student_id in enumerate(random_ordering[class_year][0]):
+            if len(assignments[student_id]) < 4:
+                student_requests[student_id].reset_preferences()
+                queue.append((0, rank, position, student_id))
+    heapq.heapify(queue)
+
+    while queue and open_seats:
+        turn, rank, position, student_id = heapq.heappop(queue)
+        course = _next_open_request(student_requests[student_id], open_seats,
+                                    assignments[student_id])
+        if course is None: # nothing left for this student
+            continue
+
+        courses[course] -= 1
+        open_seats[course] -= 1
+        if open_seats[course] == 0:
+            del open_seats[course]
+        assignments[student_id].append(course)
+        if len(assignments[student_id]) < 4:
+            heapq.heappush(queue, (turn + 1, rank, position, student_id))
+
+    return assignments
+
+
+def _next_open_request(student, open_seats, taken):
+    """Returns the student's next requested CRN (in level order) that has
+    space and that they do not already have, or None. The student's WebTree
+    iterator is left just past the returned node."""
+    while (student.can_advance_preference()):
+        try:
+            requested_course = student.get_next_course()
+        except KeyError: # student didn't fill in this node
+            requested_course = None
+        student.traverse_tree()
+        if (requested_course in open_seats) and (requested_course not in taken):
+            return requested_course
+    return None
+
+
 def main():
-    if (len(sys.argv) != 2):
+    if (len(sys.argv) < 2):
         print
         print "***********************************************************"
         print "You need to supply a .csv file containing the WebTree data"
@@ -161,23 +236,61 @@ def main():
         print "***********************************************************"
         print
         return
-    
-    # Read in data
-    student_requests, students_by_class, courses = read_file(sys.argv[1])
+
+    parser = argparse.ArgumentParser(description="Run the WebTree lottery.")
+    parser.add_argument('filename', help="a .csv file of WebTree data")
+    parser.add_argument('--format', choices=results.FORMATS, default='text',
+                        help="result format (default: text)")
+    parser.add_argument('--output', help="write results here, not to stdout")
+    parser.add_argument('--instrument', metavar='REPORT',
+                        help="record the scheduler's counters and timings "
+                             "and write them to REPORT")
+    parser.add_argument('--instrument-format', default='json',
+                        choices=['json', 'csv', 'trace'],
+                        help="REPORT format (default: json)")
+    parser.add_argument('--fill-out', action='store_true',
+                        help="afterwards, give students with fewer than four "
+                             "courses any requested courses still open")
+    args = parser.parse_args()
+
+    # Read in data (memory-mapped from the binary sidecar when it is fresh)
+    store = fasttree.PreferenceStore.from_term(
+        termcache.load_term(args.filename))
 
     # Assign random numbers
-    random_ordering = assign_random_numbers(students_by_class)
+    random_ordering = assign_random_numbers(store.students_by_class())
 
-    # Run webtree
-    assignments = run_webtree(student_requests, students_by_class,
-                              courses, random_ordering)
+    # Run webtree over the array-backed store; the assignments are identical
+    # to run_webtree's for the same ordering.
+    recorder = instrument.Recorder() if args.instrument else None
+    seats = store.seats()
+    assignments = fasttree.run_webtree(store, random_ordering, seats,
+                                       recorder=recorder)
 
-    # Print results to stdout
-    for id in assignments:
-        print id,
-        for course in assignments[id]:
-            print course,
-        print
+    if args.fill_out:
+        # The fill-out phase works on Student records and the seats that the
+        # main passes left.
+        student_requests = termcache.load_term(args.filename).to_baseline()[0]
+        courses = dict(zip(store.crns.tolist(), seats))
+        fill_out(student_requests, courses, random_ordering, assignments)
+
+    if args.instrument:
+        with open(args.instrument, 'w') as report:
+            if args.instrument_format == 'csv':
+                recorder.write_csv(report)
+            elif args.instrument_format == 'trace':
+                recorder.write_trace(report)
+            else:
+                recorder.write_json(report)
+
+    # Write results to stdout (or the requested file)
+    if args.output:
+        with open(args.output, 'wb') as out:
+            results.write_results(assignments, out, args.format)
+    else:
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        results.write_results(assignments, out, args.format)
+        out.flush()
 
         
 if __name__ == "__main__":
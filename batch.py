@@ -0,0 +1,190 @@
+import argparse
+import glob
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import fasttree
+import montecarlo
+import results
+import termcache
+
+# Columns of the combined summary, one row per term.
+SUMMARY_FIELDS = ['TERM', 'STUDENTS', 'REQUESTS', 'COURSES', 'ASSIGNED',
+                  'MEAN_PER_STUDENT', 'NONE', 'UNDER_FOUR', 'CACHED',
+                  'LOAD_SECONDS', 'SCHEDULE_SECONDS', 'WRITE_SECONDS']
+
+EXTENSIONS = {'text': '.txt', 'csv': '.csv', 'jsonl': '.jsonl', 'bin': '.bin'}
+
+
+def expand(patterns):
+    """Returns the term files named by a list of file names and globs.
+
+    Each file appears once, in the order first named.
+    """
+    filenames = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        for filename in matches:
+            if filename not in filenames:
+                filenames.append(filename)
+    return filenames
+
+
+def term_names(filenames):
+    """Returns a distinct output name for each term file.
+
+    A term is named after its file, without the extension. Terms whose
+    files share a name are told apart by their directory, and if that is
+    not enough, by their position in filenames.
+    """
+    stems = [os.path.splitext(os.path.basename(f))[0] for f in filenames]
+    names = []
+    for i, (filename, stem) in enumerate(zip(filenames, stems)):
+        if stems.count(stem) > 1:
+            parent = os.path.basename(os.path.dirname(os.path.abspath(filename)))
+            stem = '%s-%s' % (parent, stem)
+        names.append(stem)
+    return [name if names.count(name) == 1 else '%s-%d' % (name, i + 1)
+            for i, name in enumerate(names)]
+
+
+def run_term(args):
+    """Loads, schedules and writes one term; runs in a pool worker.
+
+    Parameters:
+        args - a (filename, output name, output directory, format, master
+               seed) tuple.
+
+    Returns:
+        A dictionary with a value for each of SUMMARY_FIELDS.
+    """
+    filename, name, outdir, format, seed = args
+    start = time.time()
+    cached = termcache.read_cache(filename) is not None
+    term = termcache.load_term(filename)
+    store = fasttree.PreferenceStore.from_term(term)
+    loaded = time.time()
+
+    # Derive the term's seed from its contents, so that a term's result does
+    # not depend on which other terms are in the batch.
+    seed = montecarlo.draw_seed(seed, int(term.sha1[:15], 16))
+    ordering = montecarlo.seeded_ordering(montecarlo.class_lists(store), seed)
+    assignments = fasttree.run_webtree(store, ordering)
+    scheduled = time.time()
+
+    with open(os.path.join(outdir, name + EXTENSIONS[format]), 'wb') as out:
+        results.write_results(assignments, out, format)
+    written = time.time()
+
+    counts = [len(courses) for courses in assignments.values()]
+    return {'TERM': name,
+            'STUDENTS': len(store),
+            'REQUESTS': len(term),
+            'COURSES': len(store.crns),
+            'ASSIGNED': sum(counts),
+            'MEAN_PER_STUDENT': sum(counts) / float(max(len(counts), 1)),
+            'NONE': counts.count(0),
+            'UNDER_FOUR': sum(1 for n in counts if n < 4),
+            'CACHED': cached,
+            'LOAD_SECONDS': loaded - start,
+            'SCHEDULE_SECONDS': scheduled - loaded,
+            'WRITE_SECONDS': written - scheduled}
+
+
+def run_batch(filenames, outdir, format='text', seed=None, processes=None):
+    """Runs the lottery for many terms concurrently.
+
+    Terms are handed to the pool largest first, so the longest term starts
+    immediately and total wall time approaches that of the slowest term.
+    Each worker loads (from the term cache when the CSV is unchanged),
+    schedules and writes its term independently, so loading one term
+    overlaps with scheduling others.
+
+    Parameters:
+        filenames - the term CSV files.
+        outdir - directory for the per-term results and summary.csv.
+        format - one of results.FORMATS.
+        seed - master seed for reproducible orderings; by default a fresh
+               one is drawn, as main() draws fresh random numbers.
+        processes - worker processes (default: one per CPU, at most one per
+                    term); 1 runs inline.
+
+    Returns:
+        A list of summary dictionaries, in the order of filenames.
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(filenames)))
+    if seed is None:
+        seed = random.getrandbits(32)
+    names = term_names(filenames)
+    order = sorted(range(len(filenames)),
+                   key=lambda i: os.path.getsize(filenames[i]), reverse=True)
+    tasks = [(filenames[i], names[i], outdir, format, seed) for i in order]
+
+    if processes == 1:
+        done = [run_term(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            done = list(pool.imap(run_term, tasks))
+        finally:
+            pool.close()
+            pool.join()
+
+    # Results come back in task order; put them back in input order.
+    summaries = [None] * len(filenames)
+    for i, summary in zip(order, done):
+        summaries[i] = summary
+    with open(os.path.join(outdir, 'summary.csv'), 'w') as out:
+        write_summary(summaries, out)
+    return summaries
+
+
+def write_summary(summaries, out):
+    """Writes the combined per-term summary as CSV."""
+    out.write(','.join(SUMMARY_FIELDS) + '\n')
+    for summary in summaries:
+        values = []
+        for field in SUMMARY_FIELDS:
+            value = summary[field]
+            if isinstance(value, float):
+                values.append('%.4f' % value)
+            else:
+                values.append(str(value))
+        out.write(','.join(values) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the WebTree lottery for several terms at once.")
+    parser.add_argument('terms', nargs='+',
+                        help=".csv files of WebTree data, or globs such as "
+                             "'*-201?.csv'")
+    parser.add_argument('--outdir', default='batch-results',
+                        help="directory for per-term results "
+                             "(default: batch-results)")
+    parser.add_argument('--format', choices=results.FORMATS, default='text',
+                        help="result format (default: text)")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="master seed for reproducible orderings")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    args = parser.parse_args()
+
+    filenames = expand(args.terms)
+    missing = [f for f in filenames if not os.path.isfile(f)]
+    if missing:
+        parser.error("no such term file: %s" % ', '.join(missing))
+    summaries = run_batch(filenames, args.outdir, args.format, args.seed,
+                          args.processes)
+    write_summary(summaries, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
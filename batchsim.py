@@ -0,0 +1,182 @@
+import numpy as np
+
+import fasttree
+from fasttree import DONE, EMPTY, NUM_NODES
+from termcache import CLASS_YEARS
+
+# Transition tables as arrays, extended so that DONE maps to itself.
+_ON_SUCCESS = np.array(fasttree.ON_SUCCESS + (DONE,), dtype=np.intp)
+_ON_FAILURE = np.array(fasttree.ON_FAILURE + (DONE,), dtype=np.intp)
+
+
+def _failure_chains():
+    """Returns every node's failure chain as a padded matrix.
+
+    Row n lists n, ON_FAILURE[n], ON_FAILURE[ON_FAILURE[n]], ... up to (but
+    not including) DONE, padded with DONE. Failures only ever move forward
+    through the tree, so the chains are short (at most 8 nodes). A probe
+    sequence from node n is exactly a walk along row n that stops at the
+    first course with space.
+    """
+    chains = []
+    for node in range(NUM_NODES + 1):
+        chain = []
+        while node != DONE:
+            chain.append(node)
+            node = fasttree.ON_FAILURE[node]
+        chains.append(chain)
+    width = max(len(chain) for chain in chains)
+    return np.array([chain + [DONE] * (width - len(chain)) for chain in chains],
+                    dtype=np.intp)
+
+_CHAINS = _failure_chains()
+
+
+def order_arrays(store, orderings):
+    """Converts K orderings into per-pass, per-class-year row matrices.
+
+    Parameters:
+        store - a fasttree.PreferenceStore.
+        orderings - a list of K orderings, as from assign_random_numbers.
+
+    Returns:
+        A list of four dictionaries (one per pass) mapping each class year to
+        a K x class-size array of store rows, in scheduling order.
+    """
+    row_of = store.row_of
+    passes = []
+    for i in range(4):
+        by_class = {}
+        for class_year in CLASS_YEARS:
+            by_class[class_year] = np.array(
+                [[row_of[id] for id in ordering[class_year][i]]
+                 for ordering in orderings], dtype=np.intp)
+        passes.append(by_class)
+    return passes
+
+
+def run_batch_arrays(store, orderings, overrides=None):
+    """Runs K WebTree lotteries in lockstep.
+
+    Lottery k follows orderings[k] exactly as fasttree.run_webtree would;
+    the lotteries differ only in which student is scheduled at each step.
+    Each step probes all K students' current nodes with one gather and
+    compare-and-decrement on the K x courses seat matrix. The lotteries that
+    missed then gather their whole remaining failure chain at once and take
+    the first node with space, so there is no per-probe loop at all.
+
+    Parameters:
+        store - a fasttree.PreferenceStore.
+        orderings - a list of K orderings, as from assign_random_numbers.
+        overrides - an optional dictionary mapping CRNs to new ceilings,
+                    applied to every lottery.
+
+    Returns:
+        A K x students x 4 int32 array holding the course index each student
+        received in each pass, or EMPTY.
+    """
+    k_count = len(orderings)
+    num_students = len(store)
+    num_courses = len(store.crns)
+    lotteries = np.arange(k_count)
+    width = NUM_NODES + 1
+
+    # Everything is indexed through flat offsets, which NumPy gathers much
+    # faster than multi-dimensional fancy indices. Seats are laid out course
+    # by course, so lottery k's seats in course c live at c * K + k and
+    # lotteries probing the same popular course touch neighbouring memory.
+    # Blank nodes, and a DONE column so that finished cursors can be gathered
+    # safely, point at the extra seat slot that stays 0.
+    prefs = np.where(store.prefs == EMPTY, num_courses, store.prefs)
+    prefs = np.hstack([prefs, np.full((num_students, 1), num_courses,
+                                      dtype=prefs.dtype)])
+    prefs = (prefs * k_count).astype(np.intp).ravel()
+    seats = np.repeat(np.array(store.seats(overrides), dtype=np.int32),
+                      k_count)
+    seat_base = lotteries
+    cursors = np.zeros(k_count * num_students, dtype=np.intp)
+    cursor_base = lotteries * num_students
+    received = np.full(k_count * num_students * 4, EMPTY, dtype=np.int32)
+    received_base = cursor_base * 4
+
+    for i, by_class in enumerate(order_arrays(store, orderings)):
+        for class_year in CLASS_YEARS:
+            rows = by_class[class_year]
+            for j in range(rows.shape[1]):
+                students = rows[:, j]
+                slots = cursor_base + students
+                nodes = cursors.take(slots)
+                offsets = seat_base + prefs.take(students * width + nodes)
+                hit = seats.take(offsets) > 0 # there is space!
+                nodes = np.where(hit, _ON_SUCCESS.take(nodes),
+                                 _ON_FAILURE.take(nodes))
+
+                # Lotteries that missed walk the rest of their failure chain.
+                miss = np.flatnonzero(~hit & (nodes != DONE))
+                if len(miss):
+                    chain = _CHAINS.take(nodes.take(miss), axis=0)
+                    chain_offsets = (seat_base.take(miss)[:, None] +
+                                     prefs.take(students.take(miss)[:, None] *
+                                                width + chain))
+                    space = seats.take(chain_offsets) > 0
+                    first = space.argmax(axis=1)
+                    pick = np.arange(len(miss)) * chain.shape[1] + first
+                    found = space.take(pick)
+                    hit[miss] = found
+                    offsets[miss] = chain_offsets.take(pick)
+                    # Failing every node on the chain exhausts the tree.
+                    nodes[miss] = np.where(
+                        found, _ON_SUCCESS.take(chain.take(pick)), DONE)
+
+                seats[offsets[hit]] -= 1
+                cursors[slots] = nodes
+                received[received_base[hit] + students[hit] * 4 + i] = \
+                    (offsets[hit] - seat_base[hit]) // k_count
+
+    received = received.reshape(k_count, num_students, 4)
+    return received
+
+
+def received_array(store, assignments):
+    """Returns one run's assignments in the layout of run_batch_arrays.
+
+    Parameters:
+        store - a fasttree.PreferenceStore.
+        assignments - as returned by fasttree.run_webtree with as_indices.
+
+    Returns:
+        A students x 4 int32 array holding the course index each student
+        received in each pass, or EMPTY.
+    """
+    row_of = store.row_of
+    received = np.full((len(store), 4), EMPTY, dtype=np.int32)
+    for id, courses in assignments.items():
+        received[row_of[id], :len(courses)] = courses
+    return received
+
+
+def run_batch(store, orderings, overrides=None):
+    """Runs K WebTree lotteries in lockstep.
+
+    Building K dictionaries costs about as much as running in lockstep
+    saves, so this is for checking results against fasttree.run_webtree.
+    Callers that only count outcomes should use run_batch_arrays, as
+    montecarlo.run_draws does.
+
+    Parameters:
+        See run_batch_arrays.
+
+    Returns:
+        A list of K assignment dictionaries, each identical to what
+        fasttree.run_webtree returns for the corresponding ordering.
+    """
+    received = run_batch_arrays(store, orderings, overrides)
+    ids = store.ids.tolist()
+    crns = store.crns.tolist()
+    results = []
+    for k in range(len(orderings)):
+        assignments = {}
+        for id, courses in zip(ids, received[k].tolist()):
+            assignments[id] = [crns[c] for c in courses if c != EMPTY]
+        results.append(assignments)
+    return results
@@ -0,0 +1,158 @@
+import argparse
+import gc
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import baseline_webtree
+import fasttree
+import results
+import synth
+import termcache
+
+# Stages in pipeline order. Each is run in a fresh process after the stages
+# it depends on, so that its peak RSS and allocations are its own.
+STAGES = ['read_file', 'load_term', 'assign_random_numbers', 'run_webtree',
+          'fasttree.run_webtree'] + ['output:' + f for f in results.FORMATS]
+
+
+class _DevNull:
+    """Write-only sink that discards everything, like writing to /dev/null."""
+    def write(self, data):
+        pass
+
+
+def _run_stage(args):
+    """Runs one stage (after its prerequisites) in a pool worker.
+
+    Returns:
+        (seconds, peak RSS in kB, increase in peak RSS in kB, net live
+        objects allocated) for the stage alone.
+    """
+    stage, filename, seed = args
+    random.seed(seed)
+    state = {}
+
+    def step(name):
+        if name == 'read_file':
+            state['term'] = baseline_webtree.read_file(filename)
+        elif name == 'load_term':
+            state['store'] = fasttree.PreferenceStore.from_term(
+                termcache.load_term(filename))
+        elif name == 'assign_random_numbers':
+            state['ordering'] = baseline_webtree.assign_random_numbers(
+                state['term'][1])
+        elif name == 'run_webtree':
+            state['assignments'] = baseline_webtree.run_webtree(
+                *(state['term'] + (state['ordering'],)))
+        elif name == 'fasttree.run_webtree':
+            fasttree.run_webtree(state['store'], state['ordering'])
+        elif name.startswith('output:'):
+            results.write_results(state['assignments'], _DevNull(),
+                                  name[len('output:'):])
+
+    prerequisites = {
+        'read_file': [],
+        'load_term': [],
+        'assign_random_numbers': ['read_file'],
+        'run_webtree': ['read_file', 'assign_random_numbers'],
+        'fasttree.run_webtree': ['read_file', 'load_term',
+                                 'assign_random_numbers'],
+    }
+    for format in results.FORMATS:
+        prerequisites['output:' + format] = ['read_file',
+                                             'assign_random_numbers',
+                                             'run_webtree']
+    for name in prerequisites[stage]:
+        step(name)
+
+    gc.collect()
+    objects = len(gc.get_objects())
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    step(stage)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed, peak, peak - rss, len(gc.get_objects()) - objects
+
+
+def bench_stage(stage, filename, repeat=3, seed=0):
+    """Times one stage on one term, each repetition in a fresh process.
+
+    Parameters:
+        stage - one of STAGES.
+        filename - the WebTree CSV file.
+        repeat - the number of repetitions.
+        seed - seed for assign_random_numbers.
+
+    Returns:
+        (best seconds, peak RSS in kB, RSS growth in kB, live objects), with
+        the memory figures taken from the fastest repetition.
+    """
+    timings = []
+    for i in range(repeat):
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            timings.append(pool.apply(_run_stage, ((stage, filename, seed),)))
+        finally:
+            pool.close()
+            pool.join()
+    return min(timings)
+
+
+def bench(filenames, repeat=3, out=sys.stdout):
+    """Benchmarks every stage on every term and writes a table to out.
+
+    The term cache of each file is written before timing, so load_term
+    measures the memory-mapped path that every run after the first takes.
+    """
+    out.write('%-22s %-22s %10s %10s %10s %10s\n'
+              % ('term', 'stage', 'seconds', 'peak kB', '+RSS kB', '+objects'))
+    for filename in filenames:
+        termcache.load_term(filename)
+        for stage in STAGES:
+            seconds, peak, growth, objects = bench_stage(stage, filename,
+                                                         repeat)
+            out.write('%-22s %-22s %10.4f %10d %10d %10d\n'
+                      % (os.path.basename(filename), stage, seconds, peak,
+                         growth, objects))
+            out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time each stage of the WebTree pipeline on real and "
+                    "synthetic terms.")
+    parser.add_argument('filenames', nargs='+', help=".csv files of WebTree data")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="repetitions per stage (the best is reported)")
+    parser.add_argument('--scales', type=int, nargs='*', default=[],
+                        help="also benchmark synthetic terms this many times "
+                             "larger than the first file, e.g. 10 100")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed for the synthetic generator")
+    args = parser.parse_args()
+
+    filenames = list(args.filenames)
+    tmpdir = tempfile.mkdtemp(prefix='webtree-bench-')
+    try:
+        if args.scales:
+            templates = synth.read_students(filenames[0])
+            base = os.path.splitext(os.path.basename(filenames[0]))[0]
+            for scale in args.scales:
+                name = os.path.join(tmpdir, '%s-x%d.csv' % (base, scale))
+                with open(name, 'w') as out:
+                    synth.generate(templates, scale, out, args.seed)
+                filenames.append(name)
+        bench(filenames, args.repeat)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+import argparse
+import collections
+import heapq
+import multiprocessing
+import sys
+import weakref
+
+import numpy as np
+
+import fasttree
+import montecarlo
+import results
+import termcache
+from fasttree import EMPTY
+from termcache import CLASS_YEARS
+
+# Below this bound on the speedup (total work over the largest task's work),
+# a run is not worth splitting across processes.
+MIN_SPEEDUP = 1.5
+
+# Partitions kept per store, most recently used last.
+PLANS_PER_STORE = 8
+
+# Maps each store to its recent partitions; see plan().
+_plans = weakref.WeakKeyDictionary()
+
+
+def contended_courses(store, seats=None):
+    """Returns a mask of the courses whose outcome depends on the ordering.
+
+    A course with no seats fails every probe, and a course named at no more
+    nodes than it has seats succeeds at every probe, since a student probes
+    each node at most once. Students sharing only such courses never affect
+    one another.
+
+    Parameters:
+        store - a fasttree.PreferenceStore.
+        seats - an optional seat list from store.seats().
+
+    Returns:
+        A boolean array, one entry per course index.
+    """
+    if seats is None:
+        ceilings = store.ceilings
+    else:
+        ceilings = np.array(seats[:-1], dtype=np.int64)
+    prefs = store.prefs
+    requests = np.bincount(prefs[prefs != EMPTY], minlength=len(store.crns))
+    return (ceilings > 0) & (requests > ceilings)
+
+
+def student_components(store, seats=None):
+    """Labels the connected components of the student-course graph.
+
+    Students are joined through the contended courses they request. Labels
+    are found by propagating minimum course labels through the preference
+    matrix, all students at once, until nothing changes.
+
+    Parameters:
+        store - a fasttree.PreferenceStore.
+        seats - an optional seat list from store.seats().
+
+    Returns:
+        An int64 array with one label per student row. Students with no
+        contended course get a label of their own.
+    """
+    num_courses = len(store.crns)
+    contended = np.append(contended_courses(store, seats), False)
+    courses = np.where(contended[store.prefs], store.prefs, num_courses)
+    linked = contended[courses].any(axis=1)
+
+    # Course labels, with the sentinel num_courses for blank or uncontended
+    # nodes, which never wins a minimum.
+    labels = np.arange(num_courses + 1, dtype=np.int64)
+    mask = courses != num_courses
+    while True:
+        student_labels = labels[courses].min(axis=1)
+        new = labels.copy()
+        np.minimum.at(new, courses[mask],
+                      np.broadcast_to(student_labels[:, None],
+                                      courses.shape)[mask])
+        new = new[new] # pointer jumping shortens the chains
+        if np.array_equal(new, labels):
+            break
+        labels = new
+
+    rows = np.arange(len(store), dtype=np.int64)
+    return np.where(linked, student_labels, num_courses + 1 + rows)
+
+
+def partition(store, labels, tasks):
+    """Packs components into at most tasks groups of similar work.
+
+    A component's work is the number of nodes its students filled. The
+    heaviest components are placed first, each into the lightest group.
+
+    Parameters:
+        store - a fasttree.PreferenceStore.
+        labels - as returned by student_components.
+        tasks - the number of groups wanted.
+
+    Returns:
+        A (groups, work) pair: an array giving each student row's group, and
+        an array of each group's total work.
+    """
+    components, component_of = np.unique(labels, return_inverse=True)
+    filled = (store.prefs != EMPTY).sum(axis=1) + 1
+    work = np.bincount(component_of, weights=filled).astype(np.int64)
+
+    heap = [(0, group) for group in range(min(tasks, len(components)))]
+    group_of = np.zeros(len(components), dtype=np.intp)
+    group_work = np.zeros(len(heap), dtype=np.int64)
+    for component in np.argsort(-work, kind='mergesort').tolist():
+        load, group = heapq.heappop(heap)
+        group_of[component] = group
+        group_work[group] = load + work[component]
+        heapq.heappush(heap, (group_work[group], group))
+    return group_of[component_of], group_work
+
+
+def plan(store, seats, tasks):
+    """Returns partition(store, student_components(store, seats), tasks).
+
+    Components depend on the seats only through contended_courses, so the
+    result is kept with the store, keyed by the contended courses, and
+    repeated runs over a term label its components only once.
+    """
+    plans = _plans.get(store)
+    if plans is None:
+        plans = _plans[store] = collections.OrderedDict()
+    key = (contended_courses(store, seats).tobytes(), tasks)
+    if key in plans:
+        plans[key] = plans.pop(key)
+    else:
+        plans[key] = partition(store, student_components(store, seats), tasks)
+        if len(plans) > PLANS_PER_STORE:
+            plans.popitem(last=False)
+    return plans[key]
+
+
+def split_ordering(store, random_ordering, groups, num_groups):
+    """Splits an ordering into one ordering per group of students.
+
+    Each group keeps its students in their original relative order, in
+    every pass and class year.
+
+    Returns:
+        A list of num_groups orderings, as from assign_random_numbers.
+    """
+    orderings = [dict((class_year, []) for class_year in CLASS_YEARS)
+                 for group in range(num_groups)]
+    for class_year in CLASS_YEARS:
+        for order in random_ordering[class_year]:
+            ids = np.array(order, dtype=np.int64)
+            ids_groups = groups[np.searchsorted(store.ids, ids)]
+            for group in range(num_groups):
+                orderings[group][class_year].append(
+                    ids[ids_groups == group].tolist())
+    return orderings
+
+
+def _run_task(args):
+    """Pool task: runs one group of components in a worker.
+
+    The task carries the group's own slice of the store, which is cheaper
+    to send than having every worker load the whole term.
+    """
+    store, random_ordering, overrides = args
+    return fasttree.run_webtree(store, random_ordering,
+                                store.seats(overrides))
+
+
+def run_webtree_split(store, random_ordering, overrides=None,
+                      processes=None):
+    """Runs one WebTree lottery with independent components in parallel.
+
+    Students who share no contended course (see contended_courses) cannot
+    change each other's results, so each connected component can be run on
+    its own, with its slice of the ordering, and the results merged. The
+    assignments are identical to fasttree.run_webtree's for the same
+    ordering and ceilings.
+
+    Components are packed into about two groups per worker, and the packing
+    is kept for later runs over the same store (see plan). If that cannot
+    speed the run up by MIN_SPEEDUP, e.g. because one component holds most
+    of the students, the run is made in this process instead.
+
+    Parameters:
+        store - a fasttree.PreferenceStore.
+        random_ordering - as returned by assign_random_numbers.
+        overrides - an optional dictionary mapping CRNs to new ceilings.
+        processes - worker processes (default: one per CPU); 1 runs inline.
+
+    Returns:
+        A dictionary mapping each student id to a list of assigned CRNs.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    seats = store.seats(overrides)
+    if processes == 1:
+        return fasttree.run_webtree(store, random_ordering, seats)
+
+    groups, work = plan(store, seats, 2 * processes)
+    if work.sum() < MIN_SPEEDUP * work.max():
+        return fasttree.run_webtree(store, random_ordering, seats)
+
+    orderings = split_ordering(store, random_ordering, groups, len(work))
+    tasks = [(store.subset(np.flatnonzero(groups == group)), orderings[group],
+              overrides) for group in range(len(work))]
+    assignments = dict((id, []) for id in store.ids.tolist())
+    pool = multiprocessing.Pool(processes)
+    try:
+        for group_assignments in pool.imap_unordered(_run_task, tasks):
+            assignments.update(group_assignments)
+    finally:
+        pool.close()
+        pool.join()
+    return assignments
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a seeded WebTree lottery, splitting the term into "
+                    "independent components run in parallel.")
+    parser.add_argument('filename', help="a .csv file of WebTree data")
+    parser.add_argument('seed', type=int, help="the lottery's seed")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument('--format', choices=results.FORMATS, default='text',
+                        help="result format (default: text)")
+    args = parser.parse_args()
+
+    store = fasttree.PreferenceStore.from_term(
+        termcache.load_term(args.filename))
+    labels = student_components(store)
+    sizes = np.bincount(np.unique(labels, return_inverse=True)[1])
+    sys.stderr.write('%d components, largest %d of %d students\n'
+                     % (len(sizes), sizes.max(), len(store)))
+
+    ordering = montecarlo.seeded_ordering(montecarlo.class_lists(store),
+                                          args.seed)
+    assignments = run_webtree_split(store, ordering,
+                                    processes=args.processes)
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    results.write_results(assignments, out, args.format)
+    out.flush()
+
+
+if __name__ == "__main__":
+    main()
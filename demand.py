@@ -0,0 +1,362 @@
+import argparse
+import os
+import struct
+import sys
+
+import numpy as np
+
+import fasttree
+import termcache
+from fasttree import EMPTY, NODES, NUM_NODES
+from termcache import CLASS_YEARS
+
+# Levels of the WebTree, in level order: the root, middle and leaves of
+# trees 1-3, then the fill-in tree (#4) as one level.
+LEVELS = ([(tree, level) for tree in range(1, 4) for level in range(3)] +
+          [(4, 0)])
+LEVEL_NAMES = ['T%dL%d' % (tree, level) if tree < 4 else 'T4'
+               for tree, level in LEVELS]
+
+
+def _node_level(tree, branch):
+    """Returns the index into LEVELS of a WebTree node."""
+    if tree == 4:
+        return len(LEVELS) - 1
+    if branch == 1:
+        level = 0
+    elif branch <= 3:
+        level = 1
+    else:
+        level = 2
+    return LEVELS.index((tree, level))
+
+NODE_LEVELS = np.array([_node_level(tree, branch) for tree, branch in NODES],
+                       dtype=np.intp)
+
+PROFILE_SUFFIX = '.wtd'
+PROFILE_MAGIC = b'WTDEMND1'
+PROFILE_VERSION = 1
+
+# magic, version, term sha1, course count
+_HEADER = struct.Struct('<8sI20sQ')
+
+# Arrays stored in a profile sidecar, with their types and widths (columns
+# per course).
+_ARRAYS = [('crns', np.int32, 1), ('ceilings', np.int32, 1),
+           ('node_demand', np.int32, NUM_NODES), ('students', np.int32, 1),
+           ('first_by_class', np.int32, len(CLASS_YEARS))]
+
+
+class DemandProfile:
+    """Per-course demand for one term, before any lottery is run.
+
+    Every array has one entry (or row) per course, in CRN order.
+
+    Attributes:
+        sha1 - hex digest of the term's CSV file.
+        crns - course CRNs (int32 array).
+        ceilings - enrollment capacities (int32 array).
+        node_demand - a courses x NUM_NODES int32 matrix counting the
+                      students who put each course at each node.
+        students - the number of distinct students requesting each course.
+        first_by_class - a courses x CLASS_YEARS int32 matrix counting the
+                         students who put each course at tree #1, branch #1.
+    """
+    def __init__(self, sha1, arrays):
+        """Constructs a profile from already-built arrays.
+
+        Parameters:
+            sha1 - hex digest of the term's CSV file (string).
+            arrays - a dictionary mapping each stored array's name to it.
+        """
+        self.sha1 = sha1
+        for name, dtype, width in _ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def from_store(cls, store, sha1):
+        """Computes a profile in one level-order pass over a PreferenceStore.
+
+        Like Student.traverse_tree, the pass visits every node of every tree
+        in level order, here for all students at once. A student counts
+        towards a course's distinct demand at the first node where they
+        list it.
+
+        Parameters:
+            store - a fasttree.PreferenceStore.
+            sha1 - hex digest of the term's CSV file.
+
+        Returns:
+            A DemandProfile.
+        """
+        num_courses = len(store.crns)
+        prefs = store.prefs
+        codes = store.class_codes.astype(np.intp)
+        node_demand = np.zeros((num_courses, NUM_NODES), dtype=np.int32)
+        students = np.zeros(num_courses, dtype=np.int32)
+
+        for n in range(NUM_NODES):
+            courses = prefs[:, n]
+            filled = courses != EMPTY
+            node_demand[:, n] = np.bincount(courses[filled],
+                                            minlength=num_courses)
+            first = filled.copy()
+            for m in range(n):
+                first &= prefs[:, m] != courses
+            students += np.bincount(courses[first],
+                                    minlength=num_courses).astype(np.int32)
+
+        first_choice = prefs[:, 0]
+        filled = first_choice != EMPTY
+        first_by_class = np.bincount(
+            first_choice[filled] * len(CLASS_YEARS) + codes[filled],
+            minlength=num_courses * len(CLASS_YEARS))
+        first_by_class = first_by_class.reshape(
+            num_courses, len(CLASS_YEARS)).astype(np.int32)
+
+        return cls(sha1, {'crns': store.crns, 'ceilings': store.ceilings,
+                          'node_demand': node_demand, 'students': students,
+                          'first_by_class': first_by_class})
+
+    def first_choice(self):
+        """Returns the number of students listing each course at (1, 1)."""
+        return self.first_by_class.sum(axis=1)
+
+    def requests(self):
+        """Returns the number of nodes, over all students, naming each course.
+
+        As in baseline_webtree, a student who lists a course at two nodes can
+        be given it twice, so this bounds the seats a course can lose.
+        """
+        return self.node_demand.sum(axis=1)
+
+    def level_demand(self):
+        """Returns a courses x LEVELS matrix of requests at each tree level."""
+        levels = np.zeros((len(self.crns), len(LEVELS)), dtype=np.int64)
+        for n in range(NUM_NODES):
+            levels[:, NODE_LEVELS[n]] += self.node_demand[:, n]
+        return levels
+
+    def ratio(self):
+        """Returns distinct demand over ceiling, inf for courses with no seats."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = self.students / self.ceilings.astype(np.float64)
+        ratio[self.ceilings == 0] = np.inf
+        return ratio
+
+    def fills_in_first_pass(self):
+        """Returns a mask of the courses certain to fill during pass 1.
+
+        Every student starts pass 1 at tree #1, branch #1, so if at least
+        ceiling students put a course there, its seats are all gone by the
+        end of the pass whatever the ordering. Courses with no seats are
+        included.
+        """
+        return self.first_choice() >= self.ceilings
+
+    def never_fills(self):
+        """Returns a mask of the courses that cannot fill in any lottery."""
+        return self.requests() < self.ceilings
+
+
+def profile_path(filename):
+    """Returns the name of the sidecar holding filename's demand profile."""
+    return filename + PROFILE_SUFFIX
+
+
+def write_profile(filename, profile):
+    """Writes a profile to filename's sidecar.
+
+    The sidecar holds a fixed-size header recording the term's hash, followed
+    by each array's raw bytes aligned to 8 bytes.
+
+    Parameters:
+        filename - the name of the CSV file the profile describes.
+        profile - a DemandProfile.
+
+    Returns:
+        None.
+    """
+    header = _HEADER.pack(PROFILE_MAGIC, PROFILE_VERSION,
+                          bytes(bytearray.fromhex(profile.sha1)),
+                          len(profile.crns))
+
+    # Write to a temporary file first so that concurrent readers never see
+    # a partially-written sidecar.
+    path = profile_path(filename)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(header)
+        offset = len(header)
+        for name, dtype, width in _ARRAYS:
+            padding = -offset % 8
+            f.write(b'\0' * padding)
+            data = np.ascontiguousarray(getattr(profile, name),
+                                        dtype=dtype).tobytes()
+            f.write(data)
+            offset += padding + len(data)
+    os.rename(tmp, path)
+
+
+def read_profile(filename, sha1):
+    """Memory-maps filename's profile sidecar if it matches the term.
+
+    Parameters:
+        filename - the name of the CSV file.
+        sha1 - the hex digest of the CSV file's current contents.
+
+    Returns:
+        A DemandProfile, or None if there is no usable sidecar.
+    """
+    path = profile_path(filename)
+    try:
+        raw = np.memmap(path, dtype=np.uint8, mode='r')
+    except (IOError, OSError, ValueError):
+        return None
+    if len(raw) < _HEADER.size:
+        return None
+
+    magic, version, digest, num_courses = \
+        _HEADER.unpack(raw[:_HEADER.size].tobytes())
+    if magic != PROFILE_MAGIC or version != PROFILE_VERSION:
+        return None
+    if ''.join('%02x' % b for b in bytearray(digest)) != sha1:
+        return None
+
+    arrays = {}
+    offset = _HEADER.size
+    for name, dtype, width in _ARRAYS:
+        offset += -offset % 8
+        nbytes = num_courses * width * np.dtype(dtype).itemsize
+        if offset + nbytes > len(raw):
+            return None
+        array = raw[offset:offset + nbytes].view(dtype)
+        arrays[name] = array.reshape(num_courses, width) if width > 1 else array
+        offset += nbytes
+    return DemandProfile(sha1, arrays)
+
+
+def load_profile(filename, store=None, use_cache=True):
+    """Returns the demand profile of a WebTree CSV file.
+
+    The profile is computed only if its sidecar is missing or was made from
+    different term data; otherwise the sidecar is memory-mapped.
+
+    Parameters:
+        filename - string containing the name of the CSV file.
+        store - the term's fasttree.PreferenceStore, if already loaded.
+        use_cache - if False, always compute and never touch the sidecar.
+
+    Returns:
+        A DemandProfile.
+    """
+    term = termcache.load_term(filename, use_cache)
+    if use_cache:
+        profile = read_profile(filename, term.sha1)
+        if profile is not None:
+            return profile
+
+    if store is None:
+        store = fasttree.PreferenceStore.from_term(term)
+    profile = DemandProfile.from_store(store, term.sha1)
+    if use_cache:
+        try:
+            write_profile(filename, profile)
+        except (IOError, OSError): # e.g. read-only directory
+            pass
+    return profile
+
+
+def write_report(profile, out, top=None):
+    """Writes a text report of the most oversubscribed courses.
+
+    Parameters:
+        profile - a DemandProfile.
+        out - a file object opened for writing in text mode.
+        top - the number of courses to list (default: all).
+
+    Returns:
+        None.
+    """
+    ratio = profile.ratio()
+    first = profile.first_choice()
+    first_pass = profile.fills_in_first_pass()
+    never = profile.never_fills()
+    levels = profile.level_demand()
+    open_courses = profile.ceilings > 0
+
+    out.write('%d courses, %d seats\n' % (len(profile.crns),
+                                          profile.ceilings.sum()))
+    out.write('%d certain to fill in pass 1, %d cannot fill, %d without '
+              'seats\n' % ((first_pass & open_courses).sum(), never.sum(),
+                           (~open_courses).sum()))
+    out.write('%d with more students than seats\n\n'
+              % (open_courses & (ratio > 1)).sum())
+
+    order = np.lexsort((profile.crns, -first, -ratio, ~open_courses))
+    if top is not None:
+        order = order[:top]
+    out.write('%-6s %7s %8s %6s %6s %s  %s\n' % (
+        'CRN', 'CEILING', 'STUDENTS', 'RATIO', 'FIRST',
+        ' '.join('%5s' % name for name in LEVEL_NAMES), 'OUTLOOK'))
+    for c in order.tolist():
+        if not open_courses[c]:
+            outlook = 'no seats'
+        elif first_pass[c]:
+            outlook = 'fills in pass 1'
+        elif never[c]:
+            outlook = 'cannot fill'
+        else:
+            outlook = ''
+        out.write('%-6d %7d %8d %6.2f %6d %s  %s\n' % (
+            profile.crns[c], profile.ceilings[c], profile.students[c],
+            ratio[c], first[c],
+            ' '.join('%5d' % n for n in levels[c].tolist()), outlook))
+
+
+def write_csv(profile, out):
+    """Writes every course's profile as CSV."""
+    ratio = profile.ratio()
+    first_pass = profile.fills_in_first_pass()
+    never = profile.never_fills()
+    out.write('CRN,CEILING,STUDENTS,REQUESTS,RATIO,%s,%s,'
+              'FILLS_IN_PASS_1,CANNOT_FILL\n'
+              % (','.join('FIRST_%s' % class_year
+                          for class_year in CLASS_YEARS),
+                 ','.join(LEVEL_NAMES)))
+    rows = zip(profile.crns.tolist(), profile.ceilings.tolist(),
+               profile.students.tolist(), profile.requests().tolist(),
+               ratio.tolist(), profile.first_by_class.tolist(),
+               profile.level_demand().tolist(), first_pass.tolist(),
+               never.tolist())
+    for (crn, ceiling, students, requests, r, by_class, levels, fills,
+         cannot) in rows:
+        out.write('%d,%d,%d,%d,%s,%s,%s,%d,%d\n' % (
+            crn, ceiling, students, requests,
+            '' if r == np.inf else '%.4f' % r,
+            ','.join(map(str, by_class)), ','.join(map(str, levels)),
+            fills, cannot))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report where demand exceeds capacity in a WebTree term.")
+    parser.add_argument('filename', help="a .csv file of WebTree data")
+    parser.add_argument('--top', type=int, default=25,
+                        help="courses to list, most oversubscribed first "
+                             "(default: 25; 0 for all)")
+    parser.add_argument('--csv', action='store_true',
+                        help="write every course's profile as CSV instead")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="recompute, and do not read or write sidecars")
+    args = parser.parse_args()
+
+    profile = load_profile(args.filename, use_cache=not args.no_cache)
+    if args.csv:
+        write_csv(profile, sys.stdout)
+    else:
+        write_report(profile, sys.stdout, args.top or None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+import numpy as np
+
+from student import Student
+from termcache import CLASS_YEARS
+
+# Every WebTree node, in (tree, branch) order: trees 1-3 have seven branches
+# each, and the fill-in tree (#4) has four.
+NODES = ([(tree, branch) for tree in range(1, 4) for branch in range(1, 8)] +
+         [(4, branch) for branch in range(1, 5)])
+NUM_NODES = len(NODES)
+NODE_INDEX = dict((node, i) for i, node in enumerate(NODES))
+
+# Cursor value for a student whose WebTree has been exhausted.
+DONE = NUM_NODES
+
+# Preference matrix entry for a node the student left blank. Seat lists built
+# by PreferenceStore.seats() carry one extra, permanently-zero slot at the end,
+# so seats[EMPTY] is always 0 and an empty node fails like a full course.
+EMPTY = -1
+
+
+def _transition_table():
+    """Returns the (on_success, on_failure) node transition tables.
+
+    The tables are derived by running Student.advance_preference from every
+    node, so they can never disagree with the reference implementation.
+
+    Returns:
+        Two tuples indexed by node number. Entry n holds the node visited
+        after node n when the student does (or does not) get that course,
+        or DONE if the student's preferences are exhausted.
+    """
+    probe = Student(None, None)
+    on_success, on_failure = [], []
+    for node in NODES:
+        for got_last_class, table in ((True, on_success), (False, on_failure)):
+            probe._next_course = node
+            probe.advance_preference(got_last_class)
+            table.append(NODE_INDEX.get(probe._next_course, DONE))
+    return tuple(on_success), tuple(on_failure)
+
+ON_SUCCESS, ON_FAILURE = _transition_table()
+
+
+class TreeCursor(object):
+    """A student's position in their WebTree during one scheduling run.
+
+    Attributes:
+        base - offset of the student's row in the flattened preference matrix.
+        node - the node number to be considered next, or DONE.
+    """
+    __slots__ = ('base', 'node')
+
+    def __init__(self, row):
+        """Constructs a cursor at tree #1, branch #1 for the given row."""
+        self.base = row * NUM_NODES
+        self.node = 0
+
+
+class PreferenceStore:
+    """Array-backed store of every student's WebTree preferences.
+
+    Courses are renumbered densely, so a preference is a small course index
+    rather than a CRN.
+
+    Attributes:
+        ids - student IDs, one per matrix row (int32 array).
+        class_codes - each student's index into CLASS_YEARS (int8 array).
+        crns - course CRNs, one per course index (int32 array).
+        ceilings - enrollment capacities, one per course index (int32 array).
+        prefs - a students x NUM_NODES int32 matrix of course indices, with
+                EMPTY for nodes the student left blank.
+        row_of - a dictionary mapping student IDs to matrix rows.
+        index_of - a dictionary mapping CRNs to course indices.
+    """
+    def __init__(self, ids, class_codes, crns, ceilings, prefs):
+        """Constructs a store from already-built arrays.
+
+        Parameters:
+            See the class attributes of the same name.
+        """
+        self.ids = ids
+        self.class_codes = class_codes
+        self.crns = crns
+        self.ceilings = ceilings
+        self.prefs = prefs
+        self.row_of = dict((id, row) for row, id in enumerate(ids.tolist()))
+        self.index_of = dict((crn, c) for c, crn in enumerate(crns.tolist()))
+        self._flat_prefs = None
+
+    @classmethod
+    def from_term(cls, term):
+        """Builds a store from a termcache.TermData without a Python loop.
+
+        As in baseline_webtree.read_file, later rows win when a student fills
+        the same node twice or a course's ceiling is listed more than once,
+        and a student's class year comes from their first row.
+
+        Parameters:
+            term - a termcache.TermData object.
+
+        Returns:
+            A PreferenceStore.
+        """
+        ids, first, rows = np.unique(term.ids, return_index=True,
+                                     return_inverse=True)
+        crns, course_idx = np.unique(term.crns, return_inverse=True)
+
+        lookup = np.full((5, 8), -1, dtype=np.int32)
+        for i, (tree, branch) in enumerate(NODES):
+            lookup[tree, branch] = i
+        trees = term.trees.astype(np.intp)
+        branches = term.branches.astype(np.intp)
+        if ((trees < 1) | (trees > 4) | (branches < 1) | (branches > 7)).any():
+            raise ValueError("%s: tree/branch out of range" % term.filename)
+        nodes = lookup[trees, branches]
+        if (nodes < 0).any():
+            raise ValueError("%s: tree/branch out of range" % term.filename)
+
+        ceilings = np.zeros(len(crns), dtype=np.int32)
+        last = _last_occurrence(course_idx)
+        ceilings[course_idx[last]] = term.ceilings[last]
+
+        prefs = np.full((len(ids), NUM_NODES), EMPTY, dtype=np.int32)
+        keys = rows * NUM_NODES + nodes
+        last = _last_occurrence(keys)
+        prefs.ravel()[keys[last]] = course_idx[last]
+
+        return cls(ids.astype(np.int32), term.class_codes[first].astype(np.int8),
+                   crns.astype(np.int32), ceilings, prefs)
+
+    @classmethod
+    def from_students(cls, student_requests, courses):
+        """Builds a store from the dictionaries returned by read_file.
+
+        Parameters:
+            student_requests - a dictionary mapping IDs to Student records.
+            courses - a dictionary mapping CRNs to enrollment capacities.
+
+        Returns:
+            A PreferenceStore.
+        """
+        ids = sorted(student_requests)
+        crns = sorted(courses)
+        index_of = dict((crn, c) for c, crn in enumerate(crns))
+        codes = dict((class_year, i) for i, class_year in enumerate(CLASS_YEARS))
+
+        prefs = np.full((len(ids), NUM_NODES), EMPTY, dtype=np.int32)
+        for row, id in enumerate(ids):
+            for node, crn in student_requests[id].requests.items():
+                prefs[row, NODE_INDEX[node]] = index_of[crn]
+
+        class_codes = [codes[student_requests[id].class_year] for id in ids]
+        return cls(np.array(ids, dtype=np.int32),
+                   np.array(class_codes, dtype=np.int8),
+                   np.array(crns, dtype=np.int32),
+                   np.array([courses[crn] for crn in crns], dtype=np.int32),
+                   prefs)
+
+    def subset(self, rows):
+        """Returns a store holding only some students, with every course.
+
+        Course indices are unchanged, so seat lists and course-index results
+        carry over between the two stores.
+
+        Parameters:
+            rows - a sorted array of matrix rows to keep.
+
+        Returns:
+            A PreferenceStore.
+        """
+        return PreferenceStore(self.ids[rows], self.class_codes[rows],
+                               self.crns, self.ceilings, self.prefs[rows])
+
+    def __len__(self):
+        """Returns the number of students in the store."""
+        return len(self.ids)
+
+    def students_by_class(self):
+        """Returns a dictionary mapping class years to sets of student IDs."""
+        students_by_class = dict((class_year, set([]))
+                                 for class_year in CLASS_YEARS)
+        for id, code in zip(self.ids.tolist(), self.class_codes.tolist()):
+            students_by_class[CLASS_YEARS[code]].add(id)
+        return students_by_class
+
+    def seats(self, overrides=None):
+        """Returns a fresh, mutable list of remaining seats per course index.
+
+        The list has one extra slot at the end, which stays 0 so that an
+        EMPTY preference always fails.
+
+        Parameters:
+            overrides - an optional dictionary mapping CRNs to new ceilings.
+
+        Returns:
+            A list of integers of length len(crns) + 1.
+        """
+        seats = self.ceilings.tolist()
+        if overrides:
+            for crn, ceiling in overrides.items():
+                seats[self.index_of[crn]] = ceiling
+        seats.append(0)
+        return seats
+
+    def flat_prefs(self):
+        """Returns the preference matrix as one flat list, row after row.
+
+        Indexing a list from Python is much cheaper than indexing a NumPy
+        array, so the scheduler works from this list. It is built on first
+        use and kept for later runs; callers must not modify it.
+        """
+        if self._flat_prefs is None:
+            self._flat_prefs = self.prefs.ravel().tolist()
+        return self._flat_prefs
+
+    def cursors(self):
+        """Returns a dictionary mapping student IDs to fresh TreeCursors."""
+        return dict((id, TreeCursor(row)) for row, id in enumerate(self.ids.tolist()))
+
+
+def run_webtree(store, random_ordering, seats=None, as_indices=False,
+                recorder=None):
+    """Runs the WebTree algorithm over a PreferenceStore.
+
+    Produces exactly the assignments of baseline_webtree.run_webtree for the
+    same ordering and ceilings, but walks the precompiled ON_SUCCESS /
+    ON_FAILURE tables instead of Student objects. The store is not modified,
+    so it can be reused for any number of runs.
+
+    Parameters:
+        store - a PreferenceStore.
+        random_ordering - as returned by assign_random_numbers.
+        seats - an optional seat list from store.seats(); it is consumed.
+        as_indices - if True, report course indices rather than CRNs.
+        recorder - an optional instrument.Recorder to collect probe counters,
+                   course fill points and pass timings. Without one, each
+                   hook costs a single None check.
+
+    Returns:
+        A dictionary mapping each student id to a list of assigned CRNs.
+    """
+    if seats is None:
+        seats = store.seats()
+    prefs = store.flat_prefs()
+    if as_indices:
+        crns = list(range(len(store.crns)))
+    else:
+        crns = store.crns.tolist()
+    cursors = store.cursors()
+    on_success = ON_SUCCESS
+    on_failure = ON_FAILURE
+    assignments = dict((id, []) for id in cursors)
+
+    for i in range(4):
+        if recorder is not None:
+            recorder.begin_pass(i)
+        for class_year in CLASS_YEARS:
+            if recorder is not None:
+                recorder.begin_class_year(class_year)
+            for student_id in random_ordering[class_year][i]:
+                cursor = cursors[student_id]
+                node = cursor.node
+                base = cursor.base
+                while node != DONE:
+                    c = prefs[base + node]
+                    if seats[c] > 0: # there is space!
+                        seats[c] -= 1
+                        assignments[student_id].append(crns[c])
+                        node = on_success[node]
+                        if recorder is not None:
+                            recorder.assigned(student_id, crns[c],
+                                              seats[c] == 0, node == DONE)
+                        break
+                    node = on_failure[node]
+                    if recorder is not None:
+                        recorder.missed(student_id, c == EMPTY, node == DONE)
+                cursor.node = node
+                if recorder is not None:
+                    recorder.end_student()
+            if recorder is not None:
+                recorder.end_class_year()
+        if recorder is not None:
+            recorder.end_pass()
+
+    return assignments
+
+
+def _last_occurrence(keys):
+    """Returns the positions of the last occurrence of each distinct key."""
+    _, first_from_end = np.unique(keys[::-1], return_index=True)
+    return len(keys) - 1 - first_from_end
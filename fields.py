@@ -0,0 +1,6 @@
+""" Column layout of a WebTree term CSV file."""
+
+# Columns of a term file, in file order. The first line of every file is a
+# header naming them.
+FIELDS = ['ID','CLASS','CRN','TREE','BRANCH','COURSE_CEILING',
+          'MAJOR','MAJOR2','SUBJ','NUMB','SEQ']
@@ -0,0 +1,210 @@
+import json
+import time
+
+
+class Recorder:
+    """Collects counters and timings from one instrumented WebTree run.
+
+    Pass a Recorder as the recorder argument of fasttree.run_webtree to turn
+    instrumentation on. Without one, the scheduler skips every hook.
+
+    Attributes:
+        probes - a dictionary mapping student IDs to nodes probed.
+        empty_misses - a dictionary mapping student IDs to probes of nodes
+                       they left blank.
+        full_misses - a dictionary mapping student IDs to probes of courses
+                      that had no space left.
+        advances - a dictionary mapping True/False (whether the student got
+                   the last class) to moves through a student's WebTree, as
+                   made by Student.advance_preference.
+        exhausted - a dictionary mapping student IDs to the (pass, class
+                    year) at which their WebTree ran out.
+        fills - a dictionary mapping CRNs to the (pass, class year, position)
+                at which their last seat was taken; position is the index of
+                the student within that class year's ordering.
+        pass_seconds - wall time of each of the four passes.
+        segment_seconds - a dictionary mapping (pass, class year) to wall
+                          time.
+    """
+    def __init__(self):
+        """Constructs an empty recorder."""
+        self.probes = {}
+        self.empty_misses = {}
+        self.full_misses = {}
+        self.advances = {True: 0, False: 0}
+        self.exhausted = {}
+        self.fills = {}
+        self.pass_seconds = []
+        self.segment_seconds = {}
+        self._events = []
+        self._origin = None
+        self._pass = None
+        self._class_year = None
+        self._position = None
+
+    def begin_pass(self, i):
+        """Marks the start of scheduling pass i (0-3)."""
+        now = time.time()
+        if self._origin is None:
+            self._origin = now
+        self._pass = i
+        self._pass_start = now
+
+    def end_pass(self):
+        """Marks the end of the current pass."""
+        now = time.time()
+        self.pass_seconds.append(now - self._pass_start)
+        self._event('pass %d' % (self._pass + 1), self._pass_start, now, 1)
+
+    def begin_class_year(self, class_year):
+        """Marks the start of a class year within the current pass."""
+        self._class_year = class_year
+        self._position = 0
+        self._segment_start = time.time()
+
+    def end_class_year(self):
+        """Marks the end of the current class year."""
+        now = time.time()
+        key = (self._pass, self._class_year)
+        self.segment_seconds[key] = now - self._segment_start
+        self._event('pass %d %s' % (self._pass + 1, self._class_year),
+                    self._segment_start, now, 2)
+
+    def end_student(self):
+        """Marks that the next student in the class year's ordering is up."""
+        self._position += 1
+
+    def assigned(self, id, crn, filled, exhausted):
+        """Records a probe that gave student id a seat in crn.
+
+        Parameters:
+            id - the student's ID.
+            crn - the course assigned.
+            filled - True if that was the course's last seat.
+            exhausted - True if the student's WebTree has now run out.
+        """
+        self.probe(id)
+        if filled:
+            self.course_filled(crn)
+        self.advance(id, True, exhausted)
+
+    def missed(self, id, empty, exhausted):
+        """Records a probe that gave student id nothing.
+
+        Parameters:
+            id - the student's ID.
+            empty - True if the student left the node blank, False if its
+                    course was full.
+            exhausted - True if the student's WebTree has now run out.
+        """
+        self.probe(id)
+        if empty:
+            self.empty_node(id)
+        else:
+            self.full_course(id)
+        self.advance(id, False, exhausted)
+
+    def probe(self, id):
+        """Counts a probe of one of student id's nodes."""
+        self.probes[id] = self.probes.get(id, 0) + 1
+
+    def empty_node(self, id):
+        """Counts a probe of a node student id left blank."""
+        self.empty_misses[id] = self.empty_misses.get(id, 0) + 1
+
+    def full_course(self, id):
+        """Counts a probe of a course with no space left."""
+        self.full_misses[id] = self.full_misses.get(id, 0) + 1
+
+    def course_filled(self, crn):
+        """Records that the last seat of crn was just taken."""
+        self.fills[crn] = (self._pass, self._class_year, self._position)
+        self._events.append({'name': 'filled %d' % crn, 'ph': 'i', 's': 'g',
+                             'ts': self._micros(time.time()),
+                             'pid': 1, 'tid': 2})
+
+    def advance(self, id, got_last_class, exhausted):
+        """Counts a move through student id's WebTree."""
+        self.advances[got_last_class] += 1
+        if exhausted:
+            self.exhausted[id] = (self._pass, self._class_year)
+
+    def summary(self):
+        """Returns every counter as a JSON-serializable dictionary."""
+        students = {}
+        for id in self.probes:
+            students[str(id)] = {
+                'probes': self.probes[id],
+                'empty_misses': self.empty_misses.get(id, 0),
+                'full_misses': self.full_misses.get(id, 0),
+                'exhausted': self._position_of(self.exhausted.get(id)),
+            }
+        courses = {}
+        for crn, (i, class_year, position) in self.fills.items():
+            courses[str(crn)] = {'pass': i + 1, 'class_year': class_year,
+                                 'position': position}
+        segments = [{'pass': i + 1, 'class_year': class_year,
+                     'seconds': seconds}
+                    for (i, class_year), seconds
+                    in sorted(self.segment_seconds.items())]
+        return {
+            'totals': {
+                'probes': sum(self.probes.values()),
+                'empty_misses': sum(self.empty_misses.values()),
+                'full_misses': sum(self.full_misses.values()),
+                'advances_after_success': self.advances[True],
+                'advances_after_failure': self.advances[False],
+                'students_exhausted': len(self.exhausted),
+                'courses_filled': len(self.fills),
+            },
+            'pass_seconds': self.pass_seconds,
+            'segments': segments,
+            'students': students,
+            'courses': courses,
+        }
+
+    def write_json(self, out):
+        """Writes summary() as JSON to a text file object."""
+        json.dump(self.summary(), out, indent=1, sort_keys=True)
+        out.write('\n')
+
+    def write_csv(self, out):
+        """Writes the per-student counters, then the course fills, as CSV."""
+        out.write('ID,PROBES,EMPTY_MISSES,FULL_MISSES,EXHAUSTED_PASS,'
+                  'EXHAUSTED_CLASS\n')
+        for id in sorted(self.probes):
+            where = self.exhausted.get(id)
+            out.write('%d,%d,%d,%d,%s,%s\n' % (
+                id, self.probes[id], self.empty_misses.get(id, 0),
+                self.full_misses.get(id, 0),
+                '' if where is None else where[0] + 1,
+                '' if where is None else where[1]))
+        out.write('\nCRN,FILLED_PASS,FILLED_CLASS,FILLED_POSITION\n')
+        for crn in sorted(self.fills):
+            i, class_year, position = self.fills[crn]
+            out.write('%d,%d,%s,%d\n' % (crn, i + 1, class_year, position))
+
+    def write_trace(self, out):
+        """Writes a Chrome trace (chrome://tracing, Perfetto) of the run.
+
+        Passes and class years appear as nested spans, and each course fill
+        as an instant event.
+        """
+        json.dump({'traceEvents': self._events, 'displayTimeUnit': 'ms'}, out)
+        out.write('\n')
+
+    def _event(self, name, start, end, tid):
+        """Adds a complete span to the trace."""
+        self._events.append({'name': name, 'ph': 'X', 'pid': 1, 'tid': tid,
+                             'ts': self._micros(start),
+                             'dur': (end - start) * 1e6})
+
+    def _micros(self, t):
+        """Returns microseconds since the run began."""
+        return (t - self._origin) * 1e6
+
+    def _position_of(self, where):
+        """Formats an optional (pass, class year) pair for summary()."""
+        if where is None:
+            return None
+        return {'pass': where[0] + 1, 'class_year': where[1]}
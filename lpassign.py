@@ -0,0 +1,171 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+from ortools.linear_solver import linear_solver_pb2
+from ortools.linear_solver import pywraplp
+
+import fasttree
+import results
+import termcache
+import weights
+from weights import MAX_COURSES
+
+
+class AssignmentLP:
+    """Weighted student-course assignment, solved as a linear program.
+
+    There is one variable per distinct requested (student, course) pair,
+    bounded by [0, 1], and the objective maximizes the total weight of the
+    pairs assigned. Each student may take at most MAX_COURSES courses and
+    each course at most its ceiling. Both constraint families have a single
+    1 per variable, so the constraint matrix is totally unimodular and GLOP's
+    basic optimal solutions are already integral.
+
+    The model is built once as an MPModelProto, filling repeated fields in
+    bulk rather than calling SetCoefficient per entry, then loaded into a
+    GLOP solver. Later solves with new weights only change the objective,
+    so GLOP restarts from the previous optimal basis.
+
+    Attributes:
+        store - the fasttree.PreferenceStore being assigned.
+        rows, courses - arrays identifying each variable's pair.
+        weights - each variable's current objective coefficient.
+        timings - a dictionary of seconds spent in 'build', 'load' and, after
+                  each call to solve, 'solve'.
+    """
+    def __init__(self, store, pair_weights=None, overrides=None):
+        """Builds and loads the model.
+
+        Parameters:
+            store - a fasttree.PreferenceStore.
+            pair_weights - optional (rows, courses, weights) arrays; defaults
+                           to weights.weighted_pairs(store).
+            overrides - an optional dictionary mapping CRNs to new ceilings.
+        """
+        self.store = store
+        if pair_weights is None:
+            pair_weights = weights.weighted_pairs(store)
+        self.rows, self.courses, self.weights = pair_weights
+        self.timings = {}
+
+        start = time.time()
+        model = linear_solver_pb2.MPModelProto()
+        model.name = 'WebTreeAssignment'
+        model.maximize = True
+        for w in self.weights.tolist():
+            model.variable.add(lower_bound=0.0, upper_bound=1.0,
+                               objective_coefficient=w)
+
+        # The pairs are sorted by row, so each student's variables form one
+        # contiguous run; each course's are gathered with a stable sort.
+        seats = store.seats(overrides)[:-1]
+        self._add_rows(model, self.rows, len(store),
+                       [MAX_COURSES] * len(store), 'student')
+        self._add_rows(model, self.courses, len(seats), seats, 'course')
+        self.timings['build'] = time.time() - start
+
+        start = time.time()
+        self.solver = pywraplp.Solver('WebTreeAssignment',
+                                      pywraplp.Solver.GLOP_LINEAR_PROGRAMMING)
+        error = self.solver.LoadModelFromProto(model)
+        if error:
+            raise ValueError("could not load assignment model: %s" % error)
+        self.variables = self.solver.variables()
+        self.timings['load'] = time.time() - start
+
+    def _add_rows(self, model, owners, count, limits, prefix):
+        """Adds one "at most limit" constraint per owner to the model."""
+        order = np.argsort(owners, kind='mergesort')
+        starts = np.searchsorted(owners[order], np.arange(count + 1))
+        order = order.tolist()
+        starts = starts.tolist()
+        for i in range(count):
+            members = order[starts[i]:starts[i + 1]]
+            if not members:
+                continue
+            constraint = model.constraint.add(name='%s%d' % (prefix, i),
+                                              lower_bound=0.0,
+                                              upper_bound=limits[i])
+            constraint.var_index.extend(members)
+            constraint.coefficient.extend([1.0] * len(members))
+
+    def set_weights(self, new_weights):
+        """Replaces the objective weights, keeping the model and its basis.
+
+        Only coefficients that actually change are sent to the solver.
+
+        Parameters:
+            new_weights - an array of weights parallel to self.rows.
+        """
+        objective = self.solver.Objective()
+        changed = np.flatnonzero(np.asarray(new_weights) != self.weights)
+        for i, w in zip(changed.tolist(), np.asarray(new_weights)[changed].tolist()):
+            objective.SetCoefficient(self.variables[i], w)
+        self.weights = np.array(new_weights, copy=True)
+
+    def solve(self):
+        """Solves the model and returns the resulting assignments.
+
+        Returns:
+            A dictionary mapping each student id to a list of assigned CRNs,
+            in the format of run_webtree.
+        """
+        start = time.time()
+        status = self.solver.Solve()
+        self.timings['solve'] = time.time() - start
+        if status not in (pywraplp.Solver.OPTIMAL, pywraplp.Solver.FEASIBLE):
+            raise ValueError("assignment model could not be solved "
+                             "(status %d)" % status)
+
+        response = linear_solver_pb2.MPSolutionResponse()
+        self.solver.FillSolutionResponseProto(response)
+        values = np.array(response.variable_value)
+        chosen = np.flatnonzero(values > 0.5)
+        ids = self.store.ids.tolist()
+        crns = self.store.crns.tolist()
+        assignments = dict((id, []) for id in ids)
+        for row, c in zip(self.rows[chosen].tolist(),
+                          self.courses[chosen].tolist()):
+            assignments[ids[row]].append(crns[c])
+        return assignments
+
+
+def run_lp(student_requests, students_by_class, courses):
+    """Assigns students to courses by solving the weighted assignment LP.
+
+    An alternative to run_webtree that needs no random ordering.
+
+    Parameters:
+        See descriptions from baseline_webtree.read_file.
+
+    Returns:
+        A dictionary mapping each student id to a list assigned courses (CRNs).
+    """
+    store = fasttree.PreferenceStore.from_students(student_requests, courses)
+    return AssignmentLP(store).solve()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Assign students to courses by solving a weighted LP.")
+    parser.add_argument('filename', help="a .csv file of WebTree data")
+    parser.add_argument('--format', choices=results.FORMATS, default='text',
+                        help="result format (default: text)")
+    args = parser.parse_args()
+
+    store = fasttree.PreferenceStore.from_term(termcache.load_term(args.filename))
+    lp = AssignmentLP(store)
+    assignments = lp.solve()
+
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    results.write_results(assignments, out, args.format)
+    out.flush()
+    sys.stderr.write('%d variables: build %.3fs, load %.3fs, solve %.3fs\n'
+                     % (len(lp.variables), lp.timings['build'],
+                        lp.timings['load'], lp.timings['solve']))
+
+
+if __name__ == "__main__":
+    main()
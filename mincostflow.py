@@ -0,0 +1,220 @@
+import argparse
+import multiprocessing
+import resource
+import sys
+import time
+
+import numpy as np
+try:
+    from ortools.graph.python import min_cost_flow
+except ImportError: # OR-Tools before 9.4
+    min_cost_flow = None
+    from ortools.graph import pywrapgraph
+
+import fasttree
+import lpassign
+import montecarlo
+import results
+import termcache
+import weights
+from weights import MAX_COURSES
+
+
+class _FlowSolver:
+    """Thin adapter over the two OR-Tools SimpleMinCostFlow bindings.
+
+    The pybind11 binding (OR-Tools 9.4+) takes whole NumPy arrays; the older
+    SWIG binding needs one call per arc and per node.
+    """
+    def __init__(self):
+        if min_cost_flow is not None:
+            self._flow = min_cost_flow.SimpleMinCostFlow()
+        else:
+            self._flow = pywrapgraph.SimpleMinCostFlow()
+
+    def add_arcs(self, tails, heads, capacities, costs):
+        """Adds arcs given as parallel arrays; returns their indices."""
+        if min_cost_flow is not None:
+            return self._flow.add_arcs_with_capacity_and_unit_cost(
+                tails.astype(np.int32), heads.astype(np.int32),
+                capacities.astype(np.int64), costs.astype(np.int64))
+        add = self._flow.AddArcWithCapacityAndUnitCost
+        return np.array([add(*arc) for arc in zip(tails.tolist(),
+                                                   heads.tolist(),
+                                                   capacities.tolist(),
+                                                   costs.tolist())])
+
+    def set_supplies(self, nodes, supplies):
+        """Sets the supply of each listed node."""
+        if min_cost_flow is not None:
+            self._flow.set_nodes_supplies(nodes.astype(np.int32),
+                                          supplies.astype(np.int64))
+        else:
+            for node, supply in zip(nodes.tolist(), supplies.tolist()):
+                self._flow.SetNodeSupply(node, supply)
+
+    def solve(self):
+        """Solves the problem; returns True iff an optimum was found."""
+        if min_cost_flow is not None:
+            return self._flow.solve() == self._flow.OPTIMAL
+        return self._flow.Solve() == self._flow.OPTIMAL
+
+    def flows(self, arcs):
+        """Returns the flow on each listed arc as an array."""
+        if min_cost_flow is not None:
+            return self._flow.flows(arcs)
+        return np.array([self._flow.Flow(arc) for arc in arcs.tolist()])
+
+
+def solve_flow(store, pair_weights=None, overrides=None):
+    """Solves the weighted assignment as a min-cost flow problem.
+
+    The network is source -> student (capacity MAX_COURSES) -> requested
+    course (capacity 1, cost -weight) -> sink (capacity ceiling), plus a
+    zero-cost source -> sink bypass that absorbs unused supply. The minimum
+    cost flow is therefore a maximum-weight assignment, the same optimum as
+    lpassign.AssignmentLP.
+
+    Parameters:
+        store - a fasttree.PreferenceStore.
+        pair_weights - optional (rows, courses, weights) arrays; defaults
+                       to weights.weighted_pairs(store).
+        overrides - an optional dictionary mapping CRNs to new ceilings.
+
+    Returns:
+        Two arrays (rows, courses) listing the pairs assigned.
+    """
+    if pair_weights is None:
+        pair_weights = weights.weighted_pairs(store)
+    rows, courses, pair_costs = pair_weights
+    num_students = len(store)
+    num_courses = len(store.crns)
+    source = 0
+    sink = num_students + num_courses + 1
+    students = np.arange(num_students) + 1
+    course_nodes = np.arange(num_courses) + num_students + 1
+    ceilings = np.maximum(np.array(store.seats(overrides)[:-1]), 0)
+    supply = MAX_COURSES * num_students
+
+    solver = _FlowSolver()
+    pair_arcs = solver.add_arcs(rows + 1, courses + num_students + 1,
+                                np.ones(len(rows), dtype=np.int64),
+                                -np.asarray(pair_costs))
+    solver.add_arcs(np.full(num_students, source), students,
+                    np.full(num_students, MAX_COURSES), np.zeros(num_students))
+    solver.add_arcs(course_nodes, np.full(num_courses, sink), ceilings,
+                    np.zeros(num_courses))
+    solver.add_arcs(np.array([source]), np.array([sink]),
+                    np.array([supply]), np.array([0]))
+    solver.set_supplies(np.array([source, sink]), np.array([supply, -supply]))
+
+    if not solver.solve():
+        raise ValueError("assignment flow could not be solved")
+    chosen = np.flatnonzero(solver.flows(pair_arcs) > 0)
+    return rows[chosen], courses[chosen]
+
+
+def run_mincostflow(student_requests, students_by_class, courses):
+    """Assigns students to courses with a min-cost flow solver.
+
+    An alternative to run_webtree that needs no random ordering.
+
+    Parameters:
+        See descriptions from baseline_webtree.read_file.
+
+    Returns:
+        A dictionary mapping each student id to a list assigned courses (CRNs).
+    """
+    store = fasttree.PreferenceStore.from_students(student_requests, courses)
+    return _assignments(store, *solve_flow(store))
+
+
+def _assignments(store, rows, courses):
+    """Builds an assignments dictionary from parallel row/course arrays."""
+    ids = store.ids.tolist()
+    crns = store.crns.tolist()
+    assignments = dict((id, []) for id in ids)
+    for row, c in zip(rows.tolist(), courses.tolist()):
+        assignments[ids[row]].append(crns[c])
+    return assignments
+
+
+def _measure(args):
+    """Times one assignment method on one term in a fresh process.
+
+    Returns:
+        (seconds, peak RSS in kilobytes) for building the store from the
+        cached term and computing the assignments.
+    """
+    method, filename = args
+    start = time.time()
+    store = fasttree.PreferenceStore.from_term(termcache.load_term(filename))
+    if method == 'lottery':
+        ordering = montecarlo.seeded_ordering(montecarlo.class_lists(store), 0)
+        fasttree.run_webtree(store, ordering)
+    elif method == 'lp':
+        lpassign.AssignmentLP(store).solve()
+    else:
+        _assignments(store, *solve_flow(store))
+    elapsed = time.time() - start
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def compare(filenames):
+    """Reports time and peak memory of the lottery, the LP and min-cost flow.
+
+    Every measurement runs in its own child process, so that peak RSS
+    reflects one method on one term. Each term's cache is warmed first.
+
+    Parameters:
+        filenames - a list of WebTree CSV file names.
+
+    Returns:
+        A list of (filename, method, seconds, peak RSS in kilobytes).
+    """
+    measurements = []
+    for filename in filenames:
+        termcache.load_term(filename)
+        for method in ('lottery', 'lp', 'mincostflow'):
+            pool = multiprocessing.Pool(1, maxtasksperchild=1)
+            try:
+                seconds, rss = pool.apply(_measure, ((method, filename),))
+            finally:
+                pool.close()
+                pool.join()
+            measurements.append((filename, method, seconds, rss))
+    return measurements
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Assign students to courses by min-cost flow.")
+    parser.add_argument('filenames', nargs='+', metavar='filename',
+                        help="a .csv file of WebTree data")
+    parser.add_argument('--compare', action='store_true',
+                        help="instead, compare the time and memory of the "
+                             "lottery, the LP and min-cost flow on each file")
+    parser.add_argument('--format', choices=results.FORMATS, default='text',
+                        help="result format (default: text)")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.stdout.write('%-20s %-12s %9s %12s\n'
+                         % ('term', 'method', 'seconds', 'peak RSS kB'))
+        for filename, method, seconds, rss in compare(args.filenames):
+            sys.stdout.write('%-20s %-12s %9.3f %12d\n'
+                             % (filename, method, seconds, rss))
+        return
+    if len(args.filenames) != 1:
+        parser.error("give one term file, or several with --compare")
+
+    store = fasttree.PreferenceStore.from_term(
+        termcache.load_term(args.filenames[0]))
+    assignments = _assignments(store, *solve_flow(store))
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    results.write_results(assignments, out, args.format)
+    out.flush()
+
+
+if __name__ == "__main__":
+    main()
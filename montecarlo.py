@@ -0,0 +1,294 @@
+import argparse
+import hashlib
+import multiprocessing
+import random
+import sys
+
+import numpy as np
+
+import batchsim
+import fasttree
+import termcache
+from termcache import CLASS_YEARS
+
+# Draws run in lockstep by batchsim.run_batch_arrays at a time. Batches of
+# fewer than MIN_BATCH draws are run one by one with fasttree.run_webtree,
+# which is faster at that size.
+BATCH_SIZE = 256
+MIN_BATCH = 128
+
+# Per-process state for pool workers, set up once by _init_worker.
+_worker = {}
+
+
+class LotteryResults:
+    """Aggregated outcome of many lottery draws for one term.
+
+    Hits are counted per requested (student, course) pair; a pair that was
+    never requested can never be assigned, so nothing else is stored.
+
+    Attributes:
+        store - the fasttree.PreferenceStore the draws were run over.
+        draws - the number of lotteries aggregated.
+        pair_keys - sorted array of row * len(store.crns) + course index,
+                    one per distinct requested pair.
+        hits - int64 array, parallel to pair_keys, of times each pair was
+               assigned across all draws.
+    """
+    def __init__(self, store, draws, pair_keys, hits):
+        """Constructs a result set from merged counts."""
+        self.store = store
+        self.draws = draws
+        self.pair_keys = pair_keys
+        self.hits = hits
+
+    def probability(self, id, crn):
+        """Returns the estimated chance that student id was given crn."""
+        key = (self.store.row_of[id] * len(self.store.crns) +
+               self.store.index_of[crn])
+        pos = np.searchsorted(self.pair_keys, key)
+        if pos == len(self.pair_keys) or self.pair_keys[pos] != key:
+            return 0.0
+        return self.hits[pos] / float(self.draws)
+
+    def rows(self):
+        """Yields (id, crn, hits, probability) for every requested pair.
+
+        Like the baseline scheduler, a draw can give a student the same CRN
+        twice if it sits at two nodes of their tree, so a "probability" is
+        strictly the mean number of times the pair was assigned per draw.
+        """
+        num_courses = len(self.store.crns)
+        ids = self.store.ids[self.pair_keys // num_courses].tolist()
+        crns = self.store.crns[self.pair_keys % num_courses].tolist()
+        for id, crn, hits in zip(ids, crns, self.hits.tolist()):
+            yield id, crn, hits, hits / float(self.draws)
+
+
+def requested_pairs(store):
+    """Returns the sorted keys of every (student, course) pair requested.
+
+    A pair's key is row * len(store.crns) + course index.
+    """
+    rows = np.repeat(np.arange(len(store), dtype=np.int64), fasttree.NUM_NODES)
+    courses = store.prefs.ravel().astype(np.int64)
+    filled = courses != fasttree.EMPTY
+    return np.unique(rows[filled] * len(store.crns) + courses[filled])
+
+
+def draw_seed(master_seed, draw):
+    """Returns the seed for one draw, derived from the master seed.
+
+    Each draw gets its own stream regardless of which worker runs it, so
+    aggregates depend only on the master seed and the number of draws.
+    """
+    digest = hashlib.sha1(('%d:%d' % (master_seed, draw)).encode('ascii'))
+    return int(digest.hexdigest()[:16], 16)
+
+
+def class_lists(store):
+    """Returns a dictionary mapping class years to sorted lists of IDs."""
+    lists = dict((class_year, []) for class_year in CLASS_YEARS)
+    for id, code in zip(store.ids.tolist(), store.class_codes.tolist()):
+        lists[CLASS_YEARS[code]].append(id)
+    return lists
+
+
+def seeded_ordering(lists, seed):
+    """Returns a reproducible random ordering for one lottery.
+
+    Follows baseline_webtree.assign_random_numbers, but draws from a private
+    generator and starts from sorted class lists, so the same seed always
+    gives the same ordering.
+
+    Parameters:
+        lists - as returned by class_lists.
+        seed - the seed for this draw (integer).
+
+    Returns:
+        A dictionary mapping class year to a list of four scheduling orders.
+    """
+    rng = random.Random(seed)
+    random_ordering = {}
+    for class_year in CLASS_YEARS:
+        list1 = list(lists[class_year])
+        rng.shuffle(list1)
+        list3 = list(lists[class_year])
+        rng.shuffle(list3)
+        random_ordering[class_year] = [list1, list1[::-1], list3, list3[::-1]]
+    return random_ordering
+
+
+def run_draws(store, master_seed, start, stop):
+    """Runs draws [start, stop) a batch at a time.
+
+    The draws are split into even batches of at most BATCH_SIZE. A batch of
+    at least MIN_BATCH draws is run in lockstep by batchsim.run_batch_arrays;
+    a smaller one is run a draw at a time.
+
+    Yields:
+        An (orderings, received) pair per batch: the batch's orderings, and
+        a K x students x 4 array of course indices as from
+        batchsim.run_batch_arrays.
+    """
+    lists = class_lists(store)
+    batches = -(-(stop - start) // BATCH_SIZE)
+    for b in range(batches):
+        first = start + b * (stop - start) // batches
+        last = start + (b + 1) * (stop - start) // batches
+        orderings = [seeded_ordering(lists, draw_seed(master_seed, draw))
+                     for draw in range(first, last)]
+        if len(orderings) >= MIN_BATCH:
+            yield orderings, batchsim.run_batch_arrays(store, orderings)
+        else:
+            for ordering in orderings:
+                assignments = fasttree.run_webtree(store, ordering,
+                                                   as_indices=True)
+                yield ([ordering],
+                       batchsim.received_array(store, assignments)[None])
+
+
+def count_hits(store, pair_keys, master_seed, start, stop):
+    """Runs draws [start, stop) and counts hits per requested pair.
+
+    Each draw's hits are added to the running counts as soon as its batch
+    is done, so memory does not grow with the number of draws.
+
+    Returns:
+        An int64 array parallel to pair_keys.
+    """
+    num_courses = len(store.crns)
+    hits = np.zeros(len(pair_keys), dtype=np.int64)
+    for orderings, received in run_draws(store, master_seed, start, stop):
+        for run in received:
+            rows, passes = np.nonzero(run != fasttree.EMPTY)
+            keys = rows * num_courses + run[rows, passes]
+            hits += np.bincount(np.searchsorted(pair_keys, keys),
+                                minlength=len(pair_keys))
+    return hits
+
+
+def draw_tasks(draws, master_seed, processes, chunk_size=None):
+    """Splits draws into (master_seed, start, stop) tasks for a pool.
+
+    By default there are about four tasks per worker, but a task is not cut
+    below BATCH_SIZE draws unless that would leave a worker idle, since
+    run_draws runs large chunks much faster per draw.
+    """
+    if chunk_size is None:
+        chunk_size = max(-(-draws // (4 * processes)),
+                         min(BATCH_SIZE, -(-draws // processes)), 1)
+    return [(master_seed, start, min(start + chunk_size, draws))
+            for start in range(0, draws, chunk_size)]
+
+
+def _init_worker(filename):
+    """Pool initializer: maps the term's cached columns into this worker.
+
+    Only the file name crosses the process boundary. The columns come from
+    the memory-mapped sidecar, so every worker shares the same physical pages.
+    """
+    _worker['store'] = fasttree.PreferenceStore.from_term(
+        termcache.load_term(filename))
+
+
+def _run_chunk(args):
+    """Pool task: runs one chunk of draws in a worker."""
+    run_chunk, master_seed, start, stop = args
+    return run_chunk(_worker['store'], master_seed, start, stop)
+
+
+def map_draws(filename, store, run_chunk, draws, master_seed=0,
+              processes=None, chunk_size=None):
+    """Runs draws in chunks, in this process or across a pool of workers.
+
+    Workers map the term's sidecar themselves and receive only the chunk
+    function and a (seed, start, stop) triple, so callers should load the
+    term (writing its sidecar) before calling this.
+
+    Parameters:
+        filename - string containing the name of the CSV file.
+        store - the term's fasttree.PreferenceStore, for inline chunks.
+        run_chunk - a module-level function (store, master_seed, start,
+                    stop) that runs draws [start, stop) and returns a
+                    picklable result.
+        draws - the number of lotteries to run.
+        master_seed - seed from which every draw's seed is derived.
+        processes - worker processes (default: one per CPU); 1 runs inline.
+        chunk_size - draws per task (default: see draw_tasks).
+
+    Yields:
+        Each chunk's result, in the order the chunks finish.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    tasks = draw_tasks(draws, master_seed, processes, chunk_size)
+    if processes == 1:
+        for seed, start, stop in tasks:
+            yield run_chunk(store, seed, start, stop)
+        return
+
+    pool = multiprocessing.Pool(processes, _init_worker, (filename,))
+    try:
+        for result in pool.imap_unordered(
+                _run_chunk, [(run_chunk,) + task for task in tasks]):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _count_chunk(store, master_seed, start, stop):
+    """Chunk function for run_lotteries: counts hits over draws [start, stop)."""
+    return count_hits(store, requested_pairs(store), master_seed, start, stop)
+
+
+def run_lotteries(filename, draws, master_seed=0, processes=None,
+                  chunk_size=None):
+    """Runs many independent lotteries over one term and merges the results.
+
+    The term is loaded (and its sidecar written) once in the parent, and
+    the draws are run by map_draws; chunk hit counts are summed as they
+    arrive. Integer sums do not depend on arrival order, so a master seed
+    always gives identical aggregates for any number of processes.
+
+    Parameters:
+        filename - string containing the name of the CSV file.
+        draws - the number of lotteries to run.
+        master_seed - seed from which every draw's seed is derived.
+        processes - worker processes (default: one per CPU); 1 runs inline.
+        chunk_size - draws per task (default: see draw_tasks).
+
+    Returns:
+        A LotteryResults object.
+    """
+    store = fasttree.PreferenceStore.from_term(termcache.load_term(filename))
+    pair_keys = requested_pairs(store)
+    hits = np.zeros(len(pair_keys), dtype=np.int64)
+    for chunk_hits in map_draws(filename, store, _count_chunk, draws,
+                                master_seed, processes, chunk_size):
+        hits += chunk_hits
+    return LotteryResults(store, draws, pair_keys, hits)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Estimate each student's chance of getting each "
+                    "requested course over many WebTree lotteries.")
+    parser.add_argument('filename', help="a .csv file of WebTree data")
+    parser.add_argument('draws', type=int, help="number of lotteries to run")
+    parser.add_argument('--seed', type=int, default=0, help="master seed")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    args = parser.parse_args()
+
+    results = run_lotteries(args.filename, args.draws, args.seed,
+                            args.processes)
+    out = sys.stdout
+    out.write('ID,CRN,HITS,PROBABILITY\n')
+    for id, crn, hits, probability in results.rows():
+        out.write('%d,%d,%d,%.6f\n' % (id, crn, hits, probability))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+import argparse
+import collections
+import hashlib
+import inspect
+import os
+import sys
+
+import fasttree
+import montecarlo
+import results
+import termcache
+from student import Student
+
+DEFAULT_DIRECTORY = 'result-cache'
+RESULT_SUFFIX = '.bin'
+
+# Default limits: total size of the files on disk, and results held in memory.
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_ENTRIES = 32
+
+# algorithm_version() is computed once per process.
+_version = None
+
+
+def algorithm_version():
+    """Returns a digest of everything that decides a seeded lottery's result.
+
+    This covers the source of Student.advance_preference, of the code that
+    parses a term and builds its preference store, and of the code that
+    turns a seed into an ordering and an ordering into assignments, plus the
+    transition tables derived from advance_preference and termcache's
+    CLASS_YEARS, which sets the order of each pass. random.shuffle gives
+    different orderings for the same seed under different interpreters, so
+    the Python version is included too. Changing any of them changes every
+    cache key, so old results are never served for new logic.
+
+    The digest is computed on the first call and reused afterwards.
+    """
+    global _version
+    if _version is not None:
+        return _version
+    digest = hashlib.sha1()
+    for function in [Student.advance_preference, termcache.parse_csv,
+                     fasttree.PreferenceStore.from_term,
+                     fasttree._last_occurrence, fasttree._transition_table,
+                     fasttree.PreferenceStore.seats, fasttree.run_webtree,
+                     montecarlo.class_lists, montecarlo.seeded_ordering]:
+        digest.update(inspect.getsource(function).encode('utf-8'))
+    digest.update(repr((termcache.CLASS_YEARS, fasttree.ON_SUCCESS,
+                        fasttree.ON_FAILURE)).encode('ascii'))
+    digest.update(('python %d.%d' % sys.version_info[:2]).encode('ascii'))
+    _version = digest.hexdigest()
+    return _version
+
+
+def result_key(term_sha1, seed, overrides=None, version=None):
+    """Returns the cache key of one lottery.
+
+    Parameters:
+        term_sha1 - the hex digest of the term's CSV file.
+        seed - the lottery's seed, as for montecarlo.seeded_ordering.
+        overrides - an optional dictionary mapping CRNs to new ceilings.
+        version - the algorithm version (default: algorithm_version()).
+
+    Returns:
+        A hex digest.
+    """
+    if version is None:
+        version = algorithm_version()
+    changes = ','.join('%d=%d' % (crn, ceiling)
+                       for crn, ceiling in sorted((overrides or {}).items()))
+    text = '%s:%s:%d:%s' % (term_sha1, version, seed, changes)
+    return hashlib.sha1(text.encode('ascii')).hexdigest()
+
+
+class ResultCache:
+    """Lottery results stored by key, in memory and on disk.
+
+    Each result is a file in the 'bin' results format named by its key. A
+    bounded LRU of decoded results sits in front of the files. When the files
+    grow past max_bytes, the least recently used are deleted. Reading a file
+    refreshes its mtime, which is used as its last-use time.
+
+    Keys come from result_key. They include the term's hash and the algorithm
+    version, so a changed CSV or scheduler only ever misses.
+
+    Attributes:
+        directory - where result files are kept.
+        max_bytes - the limit on the total size of result files.
+        max_entries - the number of results kept in memory.
+        hits - lookups answered from memory or disk.
+        misses - lookups that found nothing.
+    """
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        """Opens (creating if needed) a cache directory."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory = collections.OrderedDict()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key):
+        """Returns the cached assignments for key, or None."""
+        assignments = self._memory.pop(key, None)
+        if assignments is None:
+            assignments = self._read(key)
+        if assignments is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(key, assignments)
+        return assignments
+
+    def put(self, key, assignments):
+        """Stores assignments under key, evicting old results if needed."""
+        path = self._path(key)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as out:
+            results.write_results(assignments, out, 'bin')
+        os.rename(tmp, path)
+        self._remember(key, assignments)
+        self._evict()
+
+    def clear(self):
+        """Deletes every cached result."""
+        self._memory.clear()
+        for name in os.listdir(self.directory):
+            if name.endswith(RESULT_SUFFIX):
+                os.remove(os.path.join(self.directory, name))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + RESULT_SUFFIX)
+
+    def _read(self, key):
+        """Decodes a result file, or returns None if there is none."""
+        path = self._path(key)
+        try:
+            ids, crns = results.read_binary(path)
+        except (IOError, OSError, ValueError):
+            return None
+        assignments = {}
+        for id, row in zip(ids.tolist(), crns.tolist()):
+            assignments[id] = [crn for crn in row if crn != 0]
+        try:
+            os.utime(path, None)
+        except OSError: # evicted meanwhile by another process
+            pass
+        return assignments
+
+    def _remember(self, key, assignments):
+        """Puts a result at the most recent end of the in-memory LRU."""
+        self._memory[key] = assignments
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self):
+        """Deletes least recently used files until under max_bytes."""
+        files = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(RESULT_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def cached_run(cache, filename, seed, overrides=None):
+    """Runs one seeded lottery, or returns its result from the cache.
+
+    On a hit nothing is scheduled; only the term's hash is needed, which the
+    term cache usually supplies without reading the CSV.
+
+    Parameters:
+        cache - a ResultCache.
+        filename - string containing the name of the CSV file.
+        seed - the lottery's seed, as for montecarlo.seeded_ordering.
+        overrides - an optional dictionary mapping CRNs to new ceilings.
+
+    Returns:
+        An (assignments, hit) pair, where hit is True if the result came
+        from the cache.
+    """
+    term = termcache.load_term(filename)
+    key = result_key(term.sha1, seed, overrides)
+    assignments = cache.get(key)
+    if assignments is not None:
+        return assignments, True
+
+    store = fasttree.PreferenceStore.from_term(term)
+    ordering = montecarlo.seeded_ordering(montecarlo.class_lists(store), seed)
+    assignments = fasttree.run_webtree(store, ordering, store.seats(overrides))
+    cache.put(key, assignments)
+    return assignments, False
+
+
+def _override(text):
+    """Parses a CRN=CEILING command-line override."""
+    try:
+        crn, ceiling = text.split('=')
+        return int(crn), int(ceiling)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected CRN=CEILING, got %r" % text)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a seeded WebTree lottery, reusing earlier results.")
+    parser.add_argument('filename', help="a .csv file of WebTree data")
+    parser.add_argument('seed', type=int, help="the lottery's seed")
+    parser.add_argument('--override', type=_override, action='append',
+                        default=[], metavar='CRN=CEILING',
+                        help="change a course's ceiling (repeatable)")
+    parser.add_argument('--format', choices=results.FORMATS, default='text',
+                        help="result format (default: text)")
+    parser.add_argument('--cache-dir', default=DEFAULT_DIRECTORY,
+                        help="where results are kept (default: %s)"
+                             % DEFAULT_DIRECTORY)
+    parser.add_argument('--max-mb', type=float,
+                        default=DEFAULT_MAX_BYTES / (1024 * 1024),
+                        help="size limit of the cache directory in MB")
+    parser.add_argument('--clear', action='store_true',
+                        help="empty the cache before running")
+    args = parser.parse_args()
+
+    cache = ResultCache(args.cache_dir, int(args.max_mb * 1024 * 1024))
+    if args.clear:
+        cache.clear()
+    try:
+        assignments, hit = cached_run(cache, args.filename, args.seed,
+                                      dict(args.override))
+    except KeyError as e:
+        parser.error("no such CRN: %s" % e.args[0])
+    sys.stderr.write('cache %s\n' % ('hit' if hit else 'miss'))
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    results.write_results(assignments, out, args.format)
+    out.flush()
+
+
+if __name__ == "__main__":
+    main()
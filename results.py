@@ -0,0 +1,108 @@
+import json
+import struct
+
+import numpy as np
+
+FORMATS = ('text', 'csv', 'jsonl', 'bin')
+
+# Students formatted per write call for the text formats.
+CHUNK_SIZE = 8192
+
+BINARY_MAGIC = b'WTRES1\0\0'
+
+# magic, CRNs per record, record count
+_HEADER = struct.Struct('<8sIQ')
+
+
+def write_results(assignments, out, format='text'):
+    """Writes an assignment of students to courses, in student ID order.
+
+    Formats:
+        text - one line per student: the ID followed by its CRNs, separated
+               by spaces (the format main() has always printed).
+        csv - a header, then one ID,CRN row per assignment; students with
+              no courses get a row with an empty CRN.
+        jsonl - one {"id": ..., "crns": [...]} object per line.
+        bin - a fixed-width binary layout that read_binary can memory-map:
+              a header, then one record per student of little-endian int32s,
+              the ID followed by its CRNs padded with 0 to the widest record.
+
+    Text formats are built a chunk of students at a time and written with a
+    single call per chunk, rather than one write per token.
+
+    Parameters:
+        assignments - a dictionary mapping student IDs to lists of CRNs.
+        out - a file object opened for writing in binary mode.
+        format - one of FORMATS.
+
+    Returns:
+        None.
+    """
+    ids = sorted(assignments)
+    if format == 'bin':
+        _write_binary(ids, assignments, out)
+        return
+    if format == 'text':
+        line = _text_line
+    elif format == 'csv':
+        line = _csv_lines
+        out.write(b'ID,CRN\n')
+    elif format == 'jsonl':
+        line = _jsonl_line
+    else:
+        raise ValueError("unknown result format %r" % format)
+
+    for start in range(0, len(ids), CHUNK_SIZE):
+        chunk = [line(id, assignments[id])
+                 for id in ids[start:start + CHUNK_SIZE]]
+        out.write(''.join(chunk).encode('ascii'))
+
+
+def read_binary(filename):
+    """Memory-maps a results file written in the 'bin' format.
+
+    Parameters:
+        filename - the name of the results file.
+
+    Returns:
+        Two read-only arrays: the student IDs, and a students x width matrix
+        of their CRNs padded with 0.
+    """
+    raw = np.memmap(filename, dtype=np.uint8, mode='r')
+    magic, width, count = _HEADER.unpack(raw[:_HEADER.size].tobytes())
+    if magic != BINARY_MAGIC:
+        raise ValueError("%s is not a WebTree results file" % filename)
+    records = raw[_HEADER.size:_HEADER.size + count * (width + 1) * 4]
+    records = records.view('<i4').reshape(count, width + 1)
+    return records[:, 0], records[:, 1:]
+
+
+def _text_line(id, crns):
+    """Formats one student for the 'text' format."""
+    return ' '.join([str(id)] + [str(crn) for crn in crns]) + '\n'
+
+
+def _csv_lines(id, crns):
+    """Formats one student for the 'csv' format."""
+    if not crns:
+        return '%d,\n' % id
+    return ''.join(['%d,%d\n' % (id, crn) for crn in crns])
+
+
+def _jsonl_line(id, crns):
+    """Formats one student for the 'jsonl' format."""
+    return '{"id": %d, "crns": %s}\n' % (id, json.dumps(crns))
+
+
+def _write_binary(ids, assignments, out):
+    """Writes the 'bin' format; see write_results."""
+    counts = np.array([len(assignments[id]) for id in ids], dtype=np.intp)
+    width = int(counts.max()) if len(ids) else 0
+    records = np.zeros((len(ids), width + 1), dtype='<i4')
+    records[:, 0] = ids
+    crns = [crn for id in ids for crn in assignments[id]]
+    rows = np.repeat(np.arange(len(ids)), counts)
+    starts = np.cumsum(counts) - counts
+    records[rows, np.arange(len(crns)) - starts[rows] + 1] = crns
+    out.write(_HEADER.pack(BINARY_MAGIC, width, len(ids)))
+    out.write(records.tobytes())
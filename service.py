@@ -0,0 +1,309 @@
+import argparse
+import collections
+import csv
+import json
+import os
+import random
+import sys
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import fasttree
+import montecarlo
+import termcache
+import whatif
+
+# Checkpointed runs kept per term, most recently used last.
+RUNS_PER_TERM = 8
+
+try:
+    _STRING_TYPES = (str, unicode)
+except NameError: # Python 3
+    _STRING_TYPES = (str,)
+
+
+class Term:
+    """A term held in memory between requests.
+
+    Parsing, class lists and requested pairs are computed once when the term
+    is loaded. Each run starts from a fresh list of seats and cursors taken
+    from the store, so nothing is rebuilt between runs. The checkpointed run
+    for each recent seed is kept, so a ceiling what-if on a seed that was
+    already run replays only the steps the changed courses can affect.
+
+    Attributes:
+        name - the term's name (its file name without extension).
+        filename - the CSV file it was loaded from.
+        store - its fasttree.PreferenceStore.
+    """
+    def __init__(self, filename):
+        """Loads a term, from its binary cache when the CSV is unchanged."""
+        self.name = os.path.splitext(os.path.basename(filename))[0]
+        self.filename = filename
+        self.store = fasttree.PreferenceStore.from_term(
+            termcache.load_term(filename))
+        self._lists = montecarlo.class_lists(self.store)
+        self._pair_keys = None
+        self._runs = collections.OrderedDict()
+
+    def describe(self):
+        """Returns a JSON-serializable summary of the term."""
+        return {'name': self.name, 'filename': self.filename,
+                'students': len(self.store), 'courses': len(self.store.crns)}
+
+    def run(self, seed, overrides=None):
+        """Returns the assignments of one lottery.
+
+        Parameters:
+            seed - the lottery's seed, as for montecarlo.seeded_ordering.
+            overrides - an optional dictionary mapping CRNs to new ceilings.
+
+        Returns:
+            A dictionary mapping each student id to a list of CRNs.
+        """
+        checkpointed = self._runs.pop(seed, None)
+        if checkpointed is None:
+            ordering = montecarlo.seeded_ordering(self._lists, seed)
+            checkpointed = whatif.CheckpointedRun(self.store, ordering)
+        self._runs[seed] = checkpointed
+        while len(self._runs) > RUNS_PER_TERM:
+            self._runs.popitem(last=False)
+
+        if overrides:
+            return checkpointed.what_if(overrides)
+        return checkpointed.assignments
+
+    def lotteries(self, draws, seed):
+        """Runs draws lotteries in this process; see montecarlo.run_lotteries.
+
+        Returns:
+            A montecarlo.LotteryResults object.
+        """
+        if self._pair_keys is None:
+            self._pair_keys = montecarlo.requested_pairs(self.store)
+        hits = montecarlo.count_hits(self.store, self._pair_keys, seed, 0,
+                                     draws)
+        return montecarlo.LotteryResults(self.store, draws, self._pair_keys,
+                                         hits)
+
+
+class RequestError(Exception):
+    """A request that cannot be answered; reported to the client as 400."""
+
+
+class Service:
+    """The terms a server answers for, and the requests it understands.
+
+    Requests and responses are JSON objects:
+
+        GET  /terms       -> {"terms": [...]}
+        POST /terms       {"filename"} -> the loaded term
+        POST /run         {"term", "seed"?, "overrides"?: {CRN: ceiling}}
+                          -> {"term", "seed", "seconds", "assignments"}
+        POST /montecarlo  {"term", "draws", "seed"?, "ids"?: [...]}
+                          -> {"term", "seed", "draws", "seconds", "pairs":
+                              [[id, crn, probability], ...]}
+
+    When no seed is given a fresh one is drawn and returned, so any result
+    can be reproduced. The term may be omitted when only one is loaded.
+    """
+    def __init__(self):
+        """Constructs a service with no terms loaded."""
+        self.terms = collections.OrderedDict()
+
+    def load(self, filename):
+        """Loads (or reloads) a term and returns it.
+
+        Raises ValueError if the file holds no requests.
+        """
+        term = Term(filename)
+        if not len(term.store):
+            raise ValueError("%s holds no requests" % filename)
+        self.terms[term.name] = term
+        return term
+
+    def handle(self, method, path, request):
+        """Answers one request.
+
+        Parameters:
+            method - 'GET' or 'POST'.
+            path - the request path.
+            request - the decoded JSON body (a dictionary).
+
+        Returns:
+            An (HTTP status, response dictionary) pair.
+        """
+        routes = {('GET', '/terms'): self._list_terms,
+                  ('POST', '/terms'): self._load_term,
+                  ('POST', '/run'): self._run,
+                  ('POST', '/montecarlo'): self._montecarlo}
+        if (method, path) not in routes:
+            return 404, {'error': "no such endpoint: %s %s" % (method, path)}
+        try:
+            return 200, routes[(method, path)](request)
+        except RequestError as e:
+            return 400, {'error': str(e)}
+
+    def _list_terms(self, request):
+        return {'terms': [term.describe() for term in self.terms.values()]}
+
+    def _load_term(self, request):
+        filename = request.get('filename')
+        if (not isinstance(filename, _STRING_TYPES) or
+                not os.path.isfile(filename)):
+            raise RequestError("no such term file: %s" % filename)
+        try:
+            return self.load(filename).describe()
+        except (IndexError, ValueError, csv.Error, IOError, OSError) as e:
+            raise RequestError("cannot load %s as a term: %s" % (filename, e))
+
+    def _run(self, request):
+        term = self._term(request)
+        seed = self._seed(request)
+        overrides = self._overrides(term, request.get('overrides'))
+        start = time.time()
+        assignments = term.run(seed, overrides)
+        return {'term': term.name, 'seed': seed,
+                'seconds': time.time() - start,
+                'assignments': dict((str(id), crns)
+                                    for id, crns in assignments.items())}
+
+    def _montecarlo(self, request):
+        term = self._term(request)
+        seed = self._seed(request)
+        try:
+            draws = int(request.get('draws', 0))
+        except (TypeError, ValueError):
+            raise RequestError("draws must be an integer")
+        if draws < 1:
+            raise RequestError("draws must be at least 1")
+        ids = request.get('ids')
+        if ids is not None:
+            if not isinstance(ids, list):
+                raise RequestError("ids must be a list of student IDs")
+            try:
+                ids = set(int(id) for id in ids)
+            except (TypeError, ValueError):
+                raise RequestError("ids must be integers")
+
+        start = time.time()
+        results = term.lotteries(draws, seed)
+        pairs = [[id, crn, probability]
+                 for id, crn, hits, probability in results.rows()
+                 if ids is None or id in ids]
+        return {'term': term.name, 'seed': seed, 'draws': draws,
+                'seconds': time.time() - start, 'pairs': pairs}
+
+    def _term(self, request):
+        name = request.get('term')
+        if name is None and len(self.terms) == 1:
+            return list(self.terms.values())[0]
+        if not isinstance(name, _STRING_TYPES) or name not in self.terms:
+            raise RequestError("no such term: %s" % name)
+        return self.terms[name]
+
+    def _seed(self, request):
+        seed = request.get('seed')
+        if seed is None:
+            return random.getrandbits(32)
+        try:
+            return int(seed)
+        except (TypeError, ValueError):
+            raise RequestError("seed must be an integer")
+
+    def _overrides(self, term, overrides):
+        if overrides is None:
+            return None
+        if not isinstance(overrides, dict):
+            raise RequestError("overrides must map CRNs to ceilings")
+        if not overrides:
+            return None
+        ceilings = {}
+        for crn, ceiling in overrides.items():
+            try:
+                crn, ceiling = int(crn), int(ceiling)
+            except (TypeError, ValueError):
+                raise RequestError("overrides must map CRNs to integers")
+            if crn not in term.store.index_of:
+                raise RequestError("no such course: %d" % crn)
+            if ceiling < 0:
+                raise RequestError("ceiling of %d is negative" % crn)
+            ceilings[crn] = ceiling
+        return ceilings
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Decodes HTTP requests for the server's Service."""
+    def do_GET(self):
+        self._answer({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        try:
+            request = json.loads(body.decode('utf-8')) if body else {}
+        except ValueError:
+            self._respond(400, {'error': "request body is not JSON"})
+            return
+        if not isinstance(request, dict):
+            self._respond(400, {'error': "request body is not a JSON object"})
+            return
+        self._answer(request)
+
+    def _answer(self, request):
+        status, response = self.server.service.handle(
+            self.command, self.path.split('?')[0], request)
+        self._respond(status, response)
+
+    def _respond(self, status, response):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(filenames, host='127.0.0.1', port=8642):
+    """Loads the terms and answers requests until interrupted.
+
+    Requests are handled one at a time, in the order they arrive.
+    """
+    service = Service()
+    for filename in filenames:
+        service.load(filename)
+    server = HTTPServer((host, port), Handler)
+    server.service = service
+    sys.stderr.write("serving %s on http://%s:%d/\n"
+                     % (', '.join(service.terms), host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Keep WebTree terms in memory and run lotteries on them "
+                    "over HTTP.")
+    parser.add_argument('filenames', nargs='*', help=".csv files of WebTree data")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8642,
+                        help="port to listen on (default: 8642)")
+    args = parser.parse_args()
+
+    missing = [f for f in args.filenames if not os.path.isfile(f)]
+    if missing:
+        parser.error("no such term file: %s" % ', '.join(missing))
+    serve(args.filenames, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
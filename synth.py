@@ -0,0 +1,89 @@
+import argparse
+import csv
+import random
+
+from fields import FIELDS
+
+
+def read_students(filename):
+    """Returns the rows of a WebTree CSV file grouped by student.
+
+    Parameters:
+        filename - string containing the name of the CSV file.
+
+    Returns:
+        A list with one entry per student, in file order; each entry is the
+        list of that student's rows (lists of strings, in FIELDS order).
+    """
+    students = []
+    index = {}
+    with open(filename, 'r') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader) # consume the first line, which is just column headers
+        for row in reader:
+            id = row[0]
+            if id not in index:
+                index[id] = len(students)
+                students.append([])
+            students[index[id]].append(row)
+    return students
+
+
+def generate(templates, scale, out, seed=0):
+    """Writes a synthetic term, scale times the size of the template term.
+
+    Each synthetic student is a copy of a randomly chosen real student: the
+    same class year, the same filled tree/branch nodes and the same courses.
+    Every real course is cloned scale times under new CRNs with the same
+    ceiling. Each synthetic student's requests for a course all go to one
+    uniformly chosen clone, so each clone's expected demand, in students as
+    well as in requests, equals the original course's. Together this
+    preserves the real distributions of class year, requests per student,
+    tree/branch fill and course oversubscription at any scale.
+
+    Parameters:
+        templates - real students, as returned by read_students.
+        scale - how many times larger the synthetic term is (integer >= 1).
+        out - a writable file object.
+        seed - seed for the random generator.
+
+    Returns:
+        The number of rows written.
+    """
+    rng = random.Random(seed)
+    ids = FIELDS.index('ID')
+    crns = FIELDS.index('CRN')
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(FIELDS)
+    written = 0
+
+    for id in range(1, len(templates) * scale + 1):
+        clones = {}
+        for row in rng.choice(templates):
+            row = list(row)
+            row[ids] = str(id)
+            crn = int(row[crns])
+            if crn not in clones:
+                clones[crn] = rng.randrange(scale)
+            row[crns] = str(crn + clones[crn] * 100000)
+            writer.writerow(row)
+            written += 1
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic WebTree term that follows the "
+                    "distributions of a real one.")
+    parser.add_argument('template', help="a real .csv file of WebTree data")
+    parser.add_argument('scale', type=int, help="size relative to template")
+    parser.add_argument('output', help="the .csv file to write")
+    parser.add_argument('--seed', type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    with open(args.output, 'w') as out:
+        generate(read_students(args.template), args.scale, out, args.seed)
+
+
+if __name__ == "__main__":
+    main()
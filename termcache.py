@@ -0,0 +1,269 @@
+import csv
+import hashlib
+import os
+import struct
+
+import numpy as np
+
+from student import Student
+
+# Class years in the order the scheduler visits them. A student's class year
+# is stored as an index into this tuple.
+CLASS_YEARS = ('SENI', 'JUNI', 'SOPH', 'FRST', 'OTHER')
+
+# Columns kept from each row of a term file, with their on-disk types.
+COLUMNS = [('ids', np.int32), ('class_codes', np.int8), ('crns', np.int32),
+           ('trees', np.int8), ('branches', np.int8), ('ceilings', np.int32)]
+
+CACHE_SUFFIX = '.wtc'
+CACHE_MAGIC = b'WTCACHE1'
+CACHE_VERSION = 1
+
+# magic, version, CSV size, CSV mtime (ns), CSV sha1, row count
+_HEADER = struct.Struct('<8sIQq20sQ')
+
+
+class TermData:
+    """Columnar representation of one term's WebTree requests.
+
+    Every attribute named in COLUMNS is a one-dimensional NumPy array with
+    one entry per row of the CSV file, in file order. When loaded from the
+    cache the arrays are read-only views onto the memory-mapped sidecar.
+
+    Attributes:
+        filename - the CSV file the data came from.
+        sha1 - hex digest of the CSV file's contents.
+    """
+    def __init__(self, filename, sha1, columns):
+        """Constructs a term from already-parsed columns.
+
+        Parameters:
+            filename - the name of the CSV file (string).
+            sha1 - hex digest of the CSV file's contents (string).
+            columns - a dictionary mapping each name in COLUMNS to an array.
+        """
+        self.filename = filename
+        self.sha1 = sha1
+        for name, dtype in COLUMNS:
+            setattr(self, name, columns[name])
+
+    def __len__(self):
+        """Returns the number of request rows in this term."""
+        return len(self.ids)
+
+    def to_baseline(self):
+        """Returns this term in the form produced by baseline_webtree.read_file.
+
+        Returns:
+            a) A dictionary mapping student IDs to Student records.
+            b) A dictionary mapping class years to sets of student IDs.
+            c) A dictionary mapping course CRNs to enrollment capacities.
+        """
+        student_requests = {}
+        students_by_class = dict((class_year, set([]))
+                                 for class_year in CLASS_YEARS)
+        courses = {}
+        rows = zip(self.ids.tolist(), self.class_codes.tolist(),
+                   self.crns.tolist(), self.trees.tolist(),
+                   self.branches.tolist(), self.ceilings.tolist())
+
+        for id, code, crn, tree, branch, ceiling in rows:
+            class_year = CLASS_YEARS[code]
+            s = student_requests.get(id)
+            if s is None:
+                s = Student(id, class_year)
+                student_requests[id] = s
+            s.add_request(crn, tree, branch)
+            students_by_class[class_year].add(id)
+            courses[crn] = ceiling
+
+        return student_requests, students_by_class, courses
+
+
+def cache_path(filename):
+    """Returns the name of the binary sidecar used to cache filename."""
+    return filename + CACHE_SUFFIX
+
+
+def file_digest(filename):
+    """Returns the hex SHA-1 digest of the contents of filename."""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parse_csv(filename):
+    """Parses a WebTree CSV file into typed columns.
+
+    Parameters:
+        filename - string containing the name of the CSV file.
+
+    Returns:
+        A dictionary mapping each name in COLUMNS to a NumPy array.
+    """
+    codes = dict((class_year, i) for i, class_year in enumerate(CLASS_YEARS))
+    ids, class_codes, crns, trees, branches, ceilings = [], [], [], [], [], []
+
+    with open(filename, 'r') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader) # consume the first line, which is just column headers
+        for row in reader:
+            try:
+                class_codes.append(codes[row[1]])
+            except KeyError:
+                raise ValueError("%s: unknown class year %r on line %d"
+                                 % (filename, row[1], reader.line_num))
+            ids.append(row[0])
+            crns.append(row[2])
+            trees.append(row[3])
+            branches.append(row[4])
+            ceilings.append(row[5])
+
+    # NumPy converts the digit strings in C, which is much cheaper than
+    # calling int() on every field.
+    values = [ids, class_codes, crns, trees, branches, ceilings]
+    columns = {}
+    for (name, dtype), column in zip(COLUMNS, values):
+        columns[name] = np.array(column, dtype=dtype)
+    return columns
+
+
+def write_cache(filename, columns, sha1=None):
+    """Writes parsed columns to filename's binary sidecar.
+
+    The sidecar holds a fixed-size header recording the CSV's size, mtime
+    and hash, followed by each column's raw bytes aligned to 8 bytes.
+
+    Parameters:
+        filename - the name of the CSV file the columns were parsed from.
+        columns - a dictionary mapping each name in COLUMNS to an array.
+        sha1 - the hex digest of the CSV file, if already known.
+
+    Returns:
+        The hex digest of the CSV file.
+    """
+    st = os.stat(filename)
+    if sha1 is None:
+        sha1 = file_digest(filename)
+    nrows = len(columns['ids'])
+    header = _HEADER.pack(CACHE_MAGIC, CACHE_VERSION, st.st_size,
+                          _mtime_ns(st), bytes(bytearray.fromhex(sha1)),
+                          nrows)
+
+    # Write to a temporary file first so that concurrent readers never see
+    # a partially-written sidecar.
+    path = cache_path(filename)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(header)
+        offset = len(header)
+        for name, dtype in COLUMNS:
+            padding = -offset % 8
+            f.write(b'\0' * padding)
+            data = np.ascontiguousarray(columns[name], dtype=dtype).tobytes()
+            f.write(data)
+            offset += padding + len(data)
+    os.rename(tmp, path)
+    return sha1
+
+
+def read_cache(filename):
+    """Memory-maps filename's binary sidecar if it is still valid.
+
+    The sidecar is valid if its recorded size and mtime match the CSV file.
+    If only the mtime differs (e.g. the file was touched or copied), the
+    contents are hashed and compared instead, and if they match the sidecar
+    is rewritten with the new mtime so that later loads skip the hash.
+
+    Parameters:
+        filename - the name of the CSV file.
+
+    Returns:
+        A (sha1, columns) pair, or None if there is no usable sidecar.
+    """
+    path = cache_path(filename)
+    try:
+        raw = np.memmap(path, dtype=np.uint8, mode='r')
+    except (IOError, OSError, ValueError):
+        return None
+    if len(raw) < _HEADER.size:
+        return None
+
+    magic, version, size, mtime, digest, nrows = \
+        _HEADER.unpack(raw[:_HEADER.size].tobytes())
+    if magic != CACHE_MAGIC or version != CACHE_VERSION:
+        return None
+    sha1 = ''.join('%02x' % b for b in bytearray(digest))
+
+    st = os.stat(filename)
+    if st.st_size != size:
+        return None
+    touched = _mtime_ns(st) != mtime
+    if touched and file_digest(filename) != sha1:
+        return None
+
+    columns = {}
+    offset = _HEADER.size
+    for name, dtype in COLUMNS:
+        offset += -offset % 8
+        nbytes = nrows * np.dtype(dtype).itemsize
+        if offset + nbytes > len(raw):
+            return None
+        columns[name] = raw[offset:offset + nbytes].view(dtype)
+        offset += nbytes
+
+    if touched:
+        try:
+            write_cache(filename, columns, sha1)
+        except (IOError, OSError): # e.g. read-only directory
+            pass
+    return sha1, columns
+
+
+def load_term(filename, use_cache=True):
+    """Returns the columnar TermData for a WebTree CSV file.
+
+    The CSV is parsed only if its sidecar is missing or stale; otherwise the
+    sidecar is memory-mapped.
+
+    Parameters:
+        filename - string containing the name of the CSV file.
+        use_cache - if False, always parse and never touch the sidecar.
+
+    Returns:
+        A TermData object.
+    """
+    if use_cache:
+        cached = read_cache(filename)
+        if cached is not None:
+            sha1, columns = cached
+            return TermData(filename, sha1, columns)
+
+    columns = parse_csv(filename)
+    if use_cache:
+        try:
+            sha1 = write_cache(filename, columns)
+        except (IOError, OSError): # e.g. read-only directory
+            sha1 = file_digest(filename)
+    else:
+        sha1 = file_digest(filename)
+    return TermData(filename, sha1, columns)
+
+
+def read_file(filename):
+    """Cached drop-in replacement for baseline_webtree.read_file.
+
+    Parameters:
+        filename - string containing the name of the CSV file.
+
+    Returns:
+        The same three dictionaries as baseline_webtree.read_file.
+    """
+    return load_term(filename).to_baseline()
+
+
+def _mtime_ns(st):
+    """Returns a stat result's modification time in integer nanoseconds."""
+    return int(round(st.st_mtime * 1e9))
@@ -1,5 +1,97 @@
 """ Assign weights to student's course selections on webtree"""
+import numpy as np
 
-food = [[]] * 100
+from fasttree import EMPTY, NODES
+from termcache import CLASS_YEARS
 
-print(food)
\ No newline at end of file
+# Most courses a student can be assigned, one per scheduling pass.
+MAX_COURSES = 4
+
+# Multiplier applied to every selection made by a student in each class year,
+# following the order in which run_webtree serves them.
+CLASS_YEAR_WEIGHTS = {'SENI': 5, 'JUNI': 4, 'SOPH': 3, 'FRST': 2, 'OTHER': 1}
+
+
+def position_weight(tree, branch):
+    """Returns the weight of a WebTree node, independent of who filled it.
+
+    Earlier trees outweigh later ones, and within trees 1-3 the root outweighs
+    its children, which outweigh the leaves. The fill-in tree (#4) is a plain
+    list, weighted by position.
+
+    Parameters:
+        tree - the tree number (1-4).
+        branch - the node within the tree (1-7, or 1-4 for tree #4).
+
+    Returns:
+        A positive integer; (1, 1) gets 15 and (4, 4) gets 1.
+    """
+    if tree == 4:
+        return 5 - branch
+    if branch == 1:
+        level = 0
+    elif branch <= 3:
+        level = 1
+    else:
+        level = 2
+    return 4 * (4 - tree) + 3 - level
+
+
+def selection_weight(tree, branch, class_year):
+    """Returns the weight of one WebTree selection.
+
+    Parameters:
+        tree - the tree number (1-4).
+        branch - the node within the tree.
+        class_year - the student's class year (string).
+
+    Returns:
+        A positive integer.
+    """
+    return position_weight(tree, branch) * CLASS_YEAR_WEIGHTS[class_year]
+
+
+def node_weights(store):
+    """Returns the weight of every node of every student's WebTree.
+
+    Parameters:
+        store - a fasttree.PreferenceStore.
+
+    Returns:
+        A students x NUM_NODES int64 matrix; entry (row, n) is
+        selection_weight of node n for that student, whether or not they
+        filled it.
+    """
+    positions = np.array([position_weight(tree, branch)
+                          for tree, branch in NODES], dtype=np.int64)
+    class_weights = np.array([CLASS_YEAR_WEIGHTS[class_year]
+                              for class_year in CLASS_YEARS], dtype=np.int64)
+    return (class_weights[store.class_codes.astype(np.intp)][:, None] *
+            positions[None, :])
+
+
+def weighted_pairs(store):
+    """Returns every requested (student, course) pair with its weight.
+
+    A student who lists the same course at several nodes is credited with
+    the heaviest of them.
+
+    Parameters:
+        store - a fasttree.PreferenceStore.
+
+    Returns:
+        Three arrays (rows, courses, weights), one entry per distinct pair,
+        sorted by row and then course index.
+    """
+    rows, nodes = np.nonzero(store.prefs != EMPTY)
+    courses = store.prefs[rows, nodes].astype(np.int64)
+    weights = node_weights(store)[rows, nodes]
+
+    # Sort by pair, heaviest first, and keep the first of each pair.
+    keys = rows * len(store.crns) + courses
+    order = np.lexsort((-weights, keys))
+    keys = keys[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    order = order[first]
+    return rows[order], courses[order], weights[order]
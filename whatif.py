@@ -0,0 +1,267 @@
+import argparse
+import bisect
+import random
+import sys
+
+import fasttree
+import montecarlo
+import termcache
+from fasttree import DONE, EMPTY, NUM_NODES, ON_SUCCESS, ON_FAILURE
+from termcache import CLASS_YEARS
+
+
+class CheckpointedRun:
+    """A WebTree run that can be cheaply re-run with different ceilings.
+
+    The run is divided into steps, one per (pass, class year, student) in
+    scheduling order. While running it records:
+
+      * a full copy of every seat count and cursor at each (pass, class
+        year) boundary;
+      * a step log of which course each step assigned and where the
+        student's cursor ended up, which turns any boundary checkpoint into
+        the exact state at any later step;
+      * the step at which each course was first probed.
+
+    A course's ceiling cannot influence anything before its first probe, so
+    a what-if run restores the state at the earliest first probe among the
+    changed courses and replays only the steps after it. The result is then
+    patched into a copy of the baseline assignments, rebuilding only the
+    students whose steps came out differently.
+
+    Attributes:
+        store - the fasttree.PreferenceStore being scheduled.
+        assignments - the baseline result, as from fasttree.run_webtree.
+    """
+    def __init__(self, store, random_ordering, overrides=None):
+        """Runs WebTree once, recording checkpoints.
+
+        Parameters:
+            store - a fasttree.PreferenceStore.
+            random_ordering - as returned by assign_random_numbers.
+            overrides - an optional dictionary mapping CRNs to ceilings to use
+                        in place of the store's.
+        """
+        self.store = store
+        self._ids = store.ids.tolist()
+        self._crns = store.crns.tolist()
+        self._initial_seats = store.seats(overrides)
+        self._segments = []
+        self._starts = []
+        self._rows = []
+        self._steps_of = [[] for row in range(len(store))]
+        step = 0
+        for i in range(4):
+            for class_year in CLASS_YEARS:
+                rows = [store.row_of[id] for id in random_ordering[class_year][i]]
+                self._segments.append(rows)
+                self._starts.append(step)
+                for row in rows:
+                    self._steps_of[row].append(step)
+                    step += 1
+                self._rows.extend(rows)
+        self._num_steps = step
+
+        seats = list(self._initial_seats)
+        cursors = [0] * len(store)
+        self._first_probe = [self._num_steps] * len(seats)
+        self._checkpoints = []
+        self._courses, self._nodes = self._run(seats, cursors, 0,
+                                               self._first_probe,
+                                               self._checkpoints)
+        self.assignments = self._assignments(self._courses)
+
+    def resume_step(self, overrides):
+        """Returns the first step whose outcome could change under overrides.
+
+        Parameters:
+            overrides - a dictionary mapping CRNs to new ceilings.
+
+        Returns:
+            A step number; equal to the number of steps in the run if none of
+            the changed courses is ever probed.
+        """
+        step = self._num_steps
+        for crn, ceiling in overrides.items():
+            c = self.store.index_of[crn]
+            if ceiling != self._initial_seats[c]:
+                step = min(step, self._first_probe[c])
+        return step
+
+    def what_if(self, overrides):
+        """Returns the assignments the run would produce with new ceilings.
+
+        The result is identical to a full run with the same ordering and the
+        changed ceilings, but only the steps from resume_step onward are
+        scheduled again.
+
+        Parameters:
+            overrides - a dictionary mapping CRNs to new ceilings.
+
+        Returns:
+            A dictionary mapping each student id to a list of assigned CRNs.
+        """
+        step = self.resume_step(overrides)
+        assignments = dict(zip(self.assignments,
+                               map(list, self.assignments.values())))
+        if step == self._num_steps:
+            return assignments
+
+        # Restore the latest boundary checkpoint, then roll it forward to
+        # the resume step from the step log.
+        segment = bisect.bisect_right(self._starts, step) - 1
+        seats, cursors = self._checkpoints[segment]
+        seats = list(seats)
+        cursors = list(cursors)
+        start = self._starts[segment]
+        rows = self._segments[segment]
+        for s in range(start, step):
+            c = self._courses[s]
+            if c != EMPTY:
+                seats[c] -= 1
+            cursors[rows[s - start]] = self._nodes[s]
+
+        # None of the changed courses has been probed yet, so their seat
+        # counts are still their ceilings. Overrides that repeat a course's
+        # current ceiling are left alone: that course may already have been
+        # probed, and its seat count is then no longer the ceiling.
+        for crn, ceiling in overrides.items():
+            c = self.store.index_of[crn]
+            if ceiling != self._initial_seats[c]:
+                seats[c] = ceiling
+
+        first_probe = [self._num_steps] * len(seats)
+        courses, _ = self._run(seats, cursors, step, first_probe)
+
+        # Only students with a step that came out differently get a new list.
+        baseline = self._courses
+        changed = set()
+        for s, c in enumerate(courses, step):
+            if c != baseline[s]:
+                changed.add(self._rows[s])
+        ids = self._ids
+        crns = self._crns
+        for row in changed:
+            got = [baseline[s] if s < step else courses[s - step]
+                   for s in self._steps_of[row]]
+            assignments[ids[row]] = [crns[c] for c in got if c != EMPTY]
+        return assignments
+
+    def _run(self, seats, cursors, step, first_probe, checkpoints=None):
+        """Schedules every step from the given one to the end of the run.
+
+        Parameters:
+            seats - seat list, as from store.seats(); it is consumed.
+            cursors - node number per store row; it is consumed.
+            step - the step to start from.
+            first_probe - list filled in with each course's first probe step.
+            checkpoints - if given, a (seats, cursors) copy is appended to it
+                          at each (pass, class year) boundary.
+
+        Returns:
+            Two lists, indexed by step from the starting step: the course
+            index assigned (or EMPTY) and the student's cursor afterwards.
+        """
+        prefs = self.store.flat_prefs()
+        on_success = ON_SUCCESS
+        on_failure = ON_FAILURE
+        assigned = []
+        nodes = []
+
+        segment = bisect.bisect_right(self._starts, step) - 1
+        position = step - self._starts[segment]
+        for rows in self._segments[segment:]:
+            if checkpoints is not None:
+                checkpoints.append((list(seats), list(cursors)))
+            for row in rows[position:]:
+                node = cursors[row]
+                base = row * NUM_NODES
+                got = EMPTY
+                while node != DONE:
+                    c = prefs[base + node]
+                    if first_probe[c] > step:
+                        first_probe[c] = step
+                    if seats[c] > 0: # there is space!
+                        seats[c] -= 1
+                        got = c
+                        node = on_success[node]
+                        break
+                    node = on_failure[node]
+                cursors[row] = node
+                assigned.append(got)
+                nodes.append(node)
+                step += 1
+            position = 0
+
+        return assigned, nodes
+
+    def _assignments(self, courses):
+        """Builds an assignments dictionary from a full run's step log."""
+        ids = self._ids
+        crns = self._crns
+        assignments = dict((id, []) for id in ids)
+        step = 0
+        for rows in self._segments:
+            for row in rows:
+                c = courses[step]
+                if c != EMPTY:
+                    assignments[ids[row]].append(crns[c])
+                step += 1
+        return assignments
+
+
+def check(store, random_ordering, trials, rng):
+    """Compares what_if against full runs on random ceiling changes.
+
+    Each trial overrides two courses: one with its current ceiling, which
+    must change nothing, and one with a new ceiling.
+
+    Parameters:
+        store - a fasttree.PreferenceStore.
+        random_ordering - as returned by assign_random_numbers.
+        trials - the number of random changes to try.
+        rng - a random.Random to draw the changes from.
+
+    Returns:
+        A list of the overrides whose what-if result was wrong.
+    """
+    run = CheckpointedRun(store, random_ordering)
+    crns = store.crns.tolist()
+    failures = []
+    for trial in range(trials):
+        same, changed = rng.sample(crns, 2)
+        ceiling = int(store.ceilings[store.index_of[changed]])
+        overrides = {same: int(store.ceilings[store.index_of[same]]),
+                     changed: max(0, ceiling + rng.choice([-3, -1, 1, 3]))}
+        expected = fasttree.run_webtree(store, random_ordering,
+                                        store.seats(overrides))
+        if run.what_if(overrides) != expected:
+            failures.append(overrides)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check what-if re-runs against full WebTree runs.")
+    parser.add_argument('filename', help="a .csv file of WebTree data")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="the lottery's seed")
+    parser.add_argument('--trials', type=int, default=100,
+                        help="random ceiling changes to try (default: 100)")
+    args = parser.parse_args()
+
+    store = fasttree.PreferenceStore.from_term(
+        termcache.load_term(args.filename))
+    ordering = montecarlo.seeded_ordering(montecarlo.class_lists(store),
+                                          args.seed)
+    failures = check(store, ordering, args.trials, random.Random(args.seed))
+    for overrides in failures:
+        sys.stdout.write('mismatch: %r\n' % overrides)
+    sys.stdout.write('%d of %d what-if runs matched\n'
+                     % (args.trials - len(failures), args.trials))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()